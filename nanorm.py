@@ -6,8 +6,24 @@
 # ==================================
 
 import sqlite3
+import base64
+import json
+import logging
+import re
+import sys
 import time
 import datetime
+import threading
+import weakref
+import functools
+import itertools
+from collections import OrderedDict, deque, namedtuple
+try:
+    import asyncio
+    from concurrent.futures import ThreadPoolExecutor
+except ImportError as e:
+    # python 2 has no asyncio, the async methods are not available there
+    asyncio = None
 try:
     import thread
 except ImportError as e:
@@ -16,11 +32,37 @@ except ImportError as e:
     unicode = str
 
 
-__VERSION__ = "1.9.14"
+__VERSION__ = "1.10.0"
 
 """
 History 
 
+1.10.0:
+compile per-model metadata once in ModelMeta
+remember existing tables instead of checking sqlite_master on every use
+bind values as sql parameters, add cached_statements setting
+add Model.bulk_insert and Model.bulk_save
+add Query.update, save() only writes the changed fields
+add Query.iterator, last() only fetches one row
+add Query.select_related
+add Query.prefetch_related and reverse relations of foreign keys
+load foreign keys lazily on first access, add <field>_id accessors
+add Session, an identity map for Model.get(id=...)
+one connection per thread in WAL mode, add pragma settings
+mutex blocks on a FIFO lock and counts wait and hold time
+add atomic() transactions with savepoints, auto commit is kept per connection
+add Query.count, exists, aggregate and group_by
+add Query.values, values_list, only and defer, loaded rows skip Model.__init__
+add index and unique options, index_together and unique_together, Query.explain
+add QueryCache of query results, invalidated by writes to their tables
+add compact models with __slots__, and Query.rows for read-only rows
+faster date and boolean conversion, add Model.migrate_legacy_values
+add awaitable asave, aget, aall, acount and async iteration run by AsyncExecutor
+add Model.db_name, Router with read_replicas setting, Query.using, attach for joins across databases
+add sql hooks, SqlStats per statement shape, SlowQueryLog and NPlusOneDetector
+add slicing of Query as limit/offset, and Query.paginate_after for keyset pagination
+add field lookups to filter, e.g. age__gte and id__in, and Model.in_bulk
+
 1.9.14:
 fix BooleanField
 
@@ -50,152 +92,1422 @@ NANO_SETTINGS = {
     "type": "sqlite3",
     "db_name": "test.db",
     "auto_commit": True,
-    "mutex_seconds": 1,
     "timeout_seconds": 10,
+    "cached_statements": 128,
+    "select_related_depth": 1,
+    "max_variables": 999,
+    "session_max_size": 10000,
+    # cache the results of all the queries, or only of those marked with Query.cache()
+    "query_cache": False,
+    "query_cache_ttl": None,
+    "query_cache_size": 1000,
+    # pragmas of new connections, None keeps the sqlite default
+    "journal_mode": "wal",
+    "synchronous": "normal",
+    "busy_timeout": 5000,
+    "cache_size": None,
+    "mmap_size": None,
+    # worker threads of AsyncExecutor, each one with its own connection
+    "async_workers": 4,
+    # db_name -> read-only copies used by Router for reads, e.g. {"app.db": ["file:app.db?mode=ro"]}
+    "read_replicas": {},
 }
 
-lock = thread.allocate_lock()
+PRAGMAS = ("journal_mode", "synchronous", "busy_timeout", "cache_size", "mmap_size")
+
+# db_name -> ConnectionPool
+pools = {}
+pools_lock = thread.allocate_lock()
+
+# db_name -> names of the tables known to exist in that database
+known_tables = {}
+
+# wrapped function name -> counters of the mutex
+mutex_stats = {}
+mutex_stats_lock = thread.allocate_lock()
+
+timer = getattr(time, "perf_counter", time.time)
+
+# wait seconds of the last mutex of the thread, for the sql hooks
+mutex_local = threading.local()
+
+logger = logging.getLogger("nanorm")
+
+
+class FairLock(object):
+    """
+    A lock that is handed to the waiting threads in arrival order.
+    """
+
+    def __init__(self):
+        self._mutex = thread.allocate_lock()
+        self._locked = False
+        self._waiters = deque()
+
+    def acquire(self, timeout=None):
+        # return True at once if the lock was free, False if we waited for it
+        with self._mutex:
+            if not self._locked:
+                self._locked = True
+                return True
+            waiter = threading.Event()
+            self._waiters.append(waiter)
+        if not waiter.wait(timeout):
+            with self._mutex:
+                if not waiter.is_set():
+                    self._waiters.remove(waiter)
+                    raise IOError('mutex lock timeout!')
+        return False
+
+    def release(self):
+        with self._mutex:
+            if self._waiters:
+                # the lock stays locked and passes to the next waiter
+                self._waiters.popleft().set()
+            else:
+                self._locked = False
+
+
+class ConnectionSlot(object):
+    """
+    A pooled connection, the lock that serializes its use and its transaction state.
+    """
+
+    def __init__(self, cx):
+        self.cx = cx
+        self.lock = FairLock()
+        self.auto_commit = NANO_SETTINGS["auto_commit"]
+        # one entry per open atomic block, None for the transaction, else the savepoint name
+        self.savepoints = []
+        # tables written in the open transaction
+        self.written_tables = set()
+        # schema names of the databases attached to the connection
+        self.attached = set()
+        # a begin is open, for python 2 which has no Connection.in_transaction
+        self.transaction = False
+        # when the write lock of the open transaction was taken, and the seconds waited for it
+        self.write_start = None
+        self.write_wait = 0.0
+
+    def in_transaction(self):
+        return getattr(self.cx, "in_transaction", self.transaction)
+
+    def committed(self):
+        # the writes are committed or rolled back, drop the results cached meanwhile
+        if self.written_tables:
+            query_cache.invalidate(*self.written_tables)
+            self.written_tables = set()
+
+
+class ConnectionPool(object):
+    """
+    Connections of one database. Each thread gets its own connection, so
+    with WAL journal mode the readers do not wait for each other or for the
+    writer. A :memory: database only lives in its connection, so there all
+    the threads share one connection.
+    """
+
+    def __init__(self, db_name):
+        self.db_name = db_name
+        self.shared = db_name in (":memory:", "")
+        self.local = threading.local()
+        self.shared_slot = None
+        self.slots = weakref.WeakSet()
+
+    def slot(self):
+        if self.shared_slot is not None:
+            return self.shared_slot
+        slot = getattr(self.local, "slot", None)
+        if slot is None:
+            with pools_lock:
+                if self.shared_slot is not None:
+                    return self.shared_slot
+                slot = ConnectionSlot(connect(self.db_name))
+                if self.shared:
+                    self.shared_slot = slot
+                else:
+                    # closed when the thread ends and drops its slot
+                    self.local.slot = slot
+                self.slots.add(slot)
+        return slot
+
+    def close(self):
+        with pools_lock:
+            for slot in list(self.slots):
+                slot.cx.close()
+            self.slots = weakref.WeakSet()
+            self.local = threading.local()
+            self.shared_slot = None
+        # a :memory: database is gone with its connection, and a file may be replaced meanwhile
+        forget_tables(self.db_name)
+
+
+def get_pool(db_name=None):
+    db_name = db_name or NANO_SETTINGS["db_name"]
+    pool = pools.get(db_name)
+    if pool is None:
+        with pools_lock:
+            pool = pools.setdefault(db_name, ConnectionPool(db_name))
+    return pool
+
+
+def get_connection(db_name=None):
+    return get_pool(db_name).slot().cx
+
+
+def close_connections(db_name=None):
+    # close the connections of all threads to the database, the current one by default
+    get_pool(db_name).close()
 
 
 def mutex(func):
+    """
+    Serialize the calls on the connection of the current thread, and count them
+    by function name in get_mutex_stats(). Only the threads sharing a :memory:
+    connection wait here. With a database file every thread has its own
+    connection, so these calls are not contended. The writers of different
+    connections wait for sqlite's write lock instead, counted as "write_lock",
+    see begin_transaction.
+    """
+    name = func.__name__
+    # the position of db_name, as in get_cursor("events.db")
+    code = func.__code__
+    index = list(code.co_varnames[:code.co_argcount]).index("db_name")
+
+    @functools.wraps(func)
     def wrapper(*arg, **kwargs):
-        global lock, NANO_SETTINGS
-        mutex_seconds = NANO_SETTINGS["mutex_seconds"]
-        timeout_seconds = NANO_SETTINGS["timeout_seconds"]
-        t = 0
-        while not lock.acquire(False):
-            print('mutex wait...')
-            t += mutex_seconds
-            if timeout_seconds and t > timeout_seconds:
-                raise IOError('mutex lock timeout!')
-            time.sleep(mutex_seconds)
-        r = func(*arg, **kwargs)
-        lock.release()
-        return r
+        db_name = arg[index] if len(arg) > index else kwargs.get("db_name")
+        lock = get_pool(db_name).slot().lock
+        start = timer()
+        free = lock.acquire(NANO_SETTINGS["timeout_seconds"] or None)
+        acquired = timer()
+        mutex_local.wait = acquired - start
+        try:
+            return func(*arg, **kwargs)
+        finally:
+            lock.release()
+            record_mutex(name, acquired - start, timer() - acquired, not free)
 
     return wrapper
 
 
-@mutex
+def record_mutex(name, wait, hold, contended):
+    with mutex_stats_lock:
+        stats = mutex_stats.get(name)
+        if stats is None:
+            stats = mutex_stats[name] = {
+                "calls": 0, "contended": 0, "wait_seconds": 0.0, "max_wait_seconds": 0.0, "hold_seconds": 0.0}
+        stats["calls"] += 1
+        stats["wait_seconds"] += wait
+        stats["hold_seconds"] += hold
+        if contended:
+            stats["contended"] += 1
+            stats["max_wait_seconds"] = max(stats["max_wait_seconds"], wait)
+
+
+def get_mutex_stats(reset=False):
+    # a copy of the counters per wrapped function, e.g. for a metrics exporter
+    with mutex_stats_lock:
+        stats = dict((name, dict(counters)) for name, counters in mutex_stats.items())
+        if reset:
+            mutex_stats.clear()
+    return stats
+
+
 def set_db_name(db_name):
+    # the threads open new connections to db_name on their next use
+    known_tables.pop(db_name, None)
+    with pools_lock:
+        pools.pop(db_name, None)
     NANO_SETTINGS["db_name"] = db_name
-    NANO_SETTINGS["cx"] = sqlite3.connect(db_name, check_same_thread=False)
+
+
+def connect(db_name):
+    kwargs = {}
+    if db_name.startswith("file:"):
+        # an uri, e.g. file:app.db?mode=ro for a read-only connection
+        assert sys.version_info >= (3, 4), 'uri database names need python 3.4+'
+        kwargs["uri"] = True
+    readonly = "mode=ro" in db_name
+    # nanorm opens the transactions itself, pysqlite would commit them before savepoint on python < 3.6
+    cx = sqlite3.connect(db_name, check_same_thread=False, isolation_level=None,
+                         cached_statements=NANO_SETTINGS["cached_statements"], **kwargs)
+    for name in PRAGMAS:
+        value = NANO_SETTINGS.get(name)
+        if value is not None and not (readonly and name == "journal_mode"):
+            cx.execute("pragma %s = %s" % (name, value))
+    return cx
+
+
+@mutex
+def get_cursor(db_name=None):
+    return get_connection(db_name).cursor()
 
 
 @mutex
-def get_cursor():
-    if not NANO_SETTINGS.get("cx"):
-        NANO_SETTINGS["cx"] = sqlite3.connect(NANO_SETTINGS["db_name"], check_same_thread=False)
-    cu = NANO_SETTINGS["cx"].cursor()
-    return cu
+def db_commit(db_name=None):
+    slot = get_pool(db_name).slot()
+    if slot.auto_commit and not slot.savepoints:
+        commit_connection(slot, db_name)
+        slot.committed()
+
+
+def forget_tables(db_name=None):
+    # make try_create_table check the tables again, e.g. after they were dropped outside nanorm
+    if db_name is None:
+        known_tables.clear()
+    else:
+        known_tables.pop(db_name, None)
+
+
+def auto_commit_close(db_name=None):
+    # only for the connection of the current thread, see also atomic()
+    get_pool(db_name).slot().auto_commit = False
+
+
+def auto_commit_open(db_name=None):
+    get_pool(db_name).slot().auto_commit = True
+    db_commit(db_name=db_name)
+
+
+class atomic(object):
+    """
+    Run the writes of a block in one transaction, as a context manager or a decorator:
+
+        with atomic():
+            a.save()
+            b.save()
+
+    Nested blocks become savepoints. A block left by an exception is rolled back.
+    The state is kept on the connection of the current thread, to the database
+    db_name, the current one by default, e.g. atomic(db_name=Event.db_name).
+    """
+
+    def __init__(self, func=None, db_name=None):
+        self.func = func
+        self.db_name = db_name
+        if func is not None:
+            functools.update_wrapper(self, func)
+
+    def __call__(self, *args, **kwargs):
+        if self.func is None:
+            # used as @atomic()
+            return atomic(args[0], self.db_name)
+        with atomic(db_name=self.db_name):
+            return self.func(*args, **kwargs)
+
+    def __get__(self, instance, owner):
+        # a decorated method, bound to its instance
+        if instance is None:
+            return self
+        return functools.partial(self.__call__, instance)
+
+    def __enter__(self):
+        db_name = self.db_name
+        slot = get_pool(db_name).slot()
+        cu = get_cursor(db_name=db_name)
+        if not slot.savepoints and not slot.in_transaction():
+            begin(cu, db_name=db_name)
+            slot.savepoints.append(None)
+        else:
+            name = "nanorm_%d" % len(slot.savepoints)
+            execute_sql(cu, "savepoint %s" % name, db_name=db_name)
+            slot.savepoints.append(name)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        db_name = self.db_name
+        slot = get_pool(db_name).slot()
+        name = slot.savepoints.pop()
+        if name is not None:
+            cu = get_cursor(db_name=db_name)
+            if exc_type is not None:
+                execute_sql(cu, "rollback to savepoint %s" % name, db_name=db_name)
+            execute_sql(cu, "release savepoint %s" % name, db_name=db_name)
+        elif exc_type is None:
+            try:
+                commit_connection(slot, db_name)
+            except Exception:
+                self.rollback(slot, db_name)
+                raise
+            slot.committed()
+        else:
+            self.rollback(slot, db_name)
+        return False
+
+    @staticmethod
+    def rollback(slot, db_name=None):
+        if slot.in_transaction():
+            slot.cx.execute("rollback")
+        end_transaction(slot)
+        slot.committed()
+        # tables created or objects cached in the transaction may be gone
+        forget_tables(db_name or NANO_SETTINGS["db_name"])
+        session = Session.current()
+        if session is not None:
+            session.clear()
+
+
+class SqlEvent(object):
+    """
+    A statement run by execute_sql or execute_many, or a commit, passed to the sql hooks.
+    duration, rowcount and error are set before the after hooks run.
+    """
+
+    __slots__ = ("sql", "params", "db_name", "lock_wait", "duration", "rowcount", "error")
+
+    def __init__(self, sql, params, db_name, lock_wait):
+        self.sql = sql
+        self.params = params
+        self.db_name = db_name
+        self.lock_wait = lock_wait
+        self.duration = None
+        self.rowcount = -1
+        self.error = None
+
+    @property
+    def shape(self):
+        return sql_shape(self.sql)
+
+
+class SqlHook(object):
+    """
+    Base class of the sql hooks, see add_sql_hook(). Hooks run in the thread
+    of the statement while its connection is locked, so they should be quick.
+    """
+
+    def before(self, event):
+        pass
+
+    def after(self, event):
+        pass
+
+
+# the hooks in order, replaced instead of changed so the threads can iterate it
+sql_hooks = ()
+sql_hooks_lock = thread.allocate_lock()
+
+
+def add_sql_hook(hook):
+    global sql_hooks
+    with sql_hooks_lock:
+        sql_hooks = sql_hooks + (hook,)
+    return hook
+
+
+def remove_sql_hook(hook):
+    global sql_hooks
+    with sql_hooks_lock:
+        sql_hooks = tuple([h for h in sql_hooks if h is not hook])
+
+
+# sql -> its shape
+sql_shapes = {}
+
+
+def sql_shape(sql):
+    # the statement with its in lists and numbers collapsed, e.g. in (?, ...) and limit N
+    shape = sql_shapes.get(sql)
+    if shape is None:
+        shape = re.sub(r"\?(, \?)+", "?, ...", re.sub(r"\b\d+\b", "N", " ".join(sql.split())))
+        if len(sql_shapes) >= 10000:
+            sql_shapes.clear()
+        sql_shapes[sql] = shape
+    return shape
+
+
+def run_hooked(cu, func, sql, params, db_name):
+    event = SqlEvent(sql, params, db_name or NANO_SETTINGS["db_name"], getattr(mutex_local, "wait", 0.0))
+    hooks = sql_hooks
+    for hook in hooks:
+        hook.before(event)
+    start = timer()
+    try:
+        return func()
+    except Exception as e:
+        event.error = e
+        raise
+    finally:
+        event.duration = timer() - start
+        if cu is not None:
+            event.rowcount = cu.rowcount
+        for hook in hooks:
+            hook.after(event)
+
+
+def commit_connection(slot, db_name=None):
+    if not slot.in_transaction():
+        return
+    if sql_hooks:
+        run_hooked(None, lambda: slot.cx.execute("commit"), "commit", (), db_name)
+    else:
+        slot.cx.execute("commit")
+    end_transaction(slot)
+
+
+class SqlStats(SqlHook):
+    """
+    Counters per statement shape, added with add_sql_hook(sql_stats) and read with get_sql_stats().
+    """
+
+    def __init__(self):
+        self.lock = thread.allocate_lock()
+        self.shapes = {}
+
+    def after(self, event):
+        shape = event.shape
+        with self.lock:
+            stats = self.shapes.get(shape)
+            if stats is None:
+                stats = self.shapes[shape] = {
+                    "calls": 0, "errors": 0, "rows": 0, "seconds": 0.0, "max_seconds": 0.0, "lock_wait_seconds": 0.0}
+            stats["calls"] += 1
+            stats["seconds"] += event.duration
+            stats["max_seconds"] = max(stats["max_seconds"], event.duration)
+            stats["lock_wait_seconds"] += event.lock_wait
+            if event.rowcount > 0:
+                stats["rows"] += event.rowcount
+            if event.error is not None:
+                stats["errors"] += 1
+
+    def export(self, reset=False):
+        with self.lock:
+            stats = dict((shape, dict(counters)) for shape, counters in self.shapes.items())
+            if reset:
+                self.shapes.clear()
+        return stats
+
+
+sql_stats = SqlStats()
+
+
+def get_sql_stats(reset=False):
+    # a copy of the counters per statement shape, collected while sql_stats is added as a hook
+    return sql_stats.export(reset)
+
+
+class SlowQueryLog(SqlHook):
+    """
+    Logs the statements that take seconds or more, to the nanorm logger by default:
+
+        add_sql_hook(SlowQueryLog(0.1))
+    """
+
+    def __init__(self, seconds=0.1, log=None):
+        self.seconds = seconds
+        self.log = log or logger.warning
+
+    def after(self, event):
+        if event.duration >= self.seconds:
+            self.log("slow sql %.3fs (lock wait %.3fs) on %s: %s %r" % (
+                event.duration, event.lock_wait, event.db_name, event.sql, event.params))
+
+
+class NPlusOneDetector(SqlHook):
+    """
+    Counts the select statements of the current thread per shape in a with block,
+    and reports the shapes run threshold times or more, e.g. the foreign keys
+    loaded one by one in a loop instead of by select_related or prefetch_related:
+
+        with NPlusOneDetector() as detector:
+            names = [user.area.name for user in User.query()]
+        assert not detector.found
+    """
+
+    def __init__(self, threshold=10, log=None, raise_error=False):
+        self.threshold = threshold
+        self.log = log or logger.warning
+        self.raise_error = raise_error
+        self.counts = {}
+        self.found = []
+        self.thread_id = None
+
+    def after(self, event):
+        if thread.get_ident() == self.thread_id and event.sql.lstrip()[:6].lower() == "select":
+            shape = event.shape
+            self.counts[shape] = self.counts.get(shape, 0) + 1
+
+    def __enter__(self):
+        self.counts = {}
+        self.found = []
+        self.thread_id = thread.get_ident()
+        add_sql_hook(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        remove_sql_hook(self)
+        self.found = sorted([(count, shape) for shape, count in self.counts.items() if count >= self.threshold], reverse=True)
+        for count, shape in self.found:
+            self.log("N+1 queries, %d times: %s" % (count, shape))
+        if self.found and self.raise_error and exc_type is None:
+            raise AssertionError('N+1 queries, %d times: %s' % self.found[0])
+        return False
+
+
+# statements that open a transaction first, see begin_write
+WRITE_VERBS = ("insert", "update", "delete", "replac")
+
+# sqlite's busy handler sleeps at least 1ms, a longer wait for the write lock counts as contended
+BUSY_SECONDS = 0.001
+
+
+def begin_transaction(cu, slot, db_name=None):
+    """
+    begin immediate takes sqlite's write lock at once, waiting in sqlite's busy
+    handler while another connection writes. The wait goes to the lock_wait of
+    the sql hooks, and with the time the lock is held to the "write_lock"
+    counters of get_mutex_stats() when the transaction ends.
+    """
+    start = timer()
+    if sql_hooks:
+        run_hooked(cu, lambda: cu.execute("begin immediate"), "begin immediate", (), db_name)
+    else:
+        cu.execute("begin immediate")
+    slot.transaction = True
+    slot.write_start = timer()
+    slot.write_wait = slot.write_start - start
+    mutex_local.wait = getattr(mutex_local, "wait", 0.0) + slot.write_wait
+
+
+def end_transaction(slot):
+    slot.transaction = False
+    if slot.write_start is not None:
+        record_mutex("write_lock", slot.write_wait, timer() - slot.write_start, slot.write_wait >= BUSY_SECONDS)
+        slot.write_start = None
 
 
 @mutex
-def db_commit():
-    if NANO_SETTINGS["auto_commit"]:
-        NANO_SETTINGS["cx"].commit()
+def begin(cu, db_name=None):
+    begin_transaction(cu, get_pool(db_name).slot(), db_name)
 
 
-def auto_commit_close():
-    NANO_SETTINGS["auto_commit"] = False
+def begin_write(cu, sql, db_name=None):
+    # the connections run in autocommit mode, so open the transaction of a write like pysqlite did,
+    # returns the slot when the transaction was opened here
+    if sql[:6].lower() in WRITE_VERBS:
+        slot = get_pool(db_name).slot()
+        if not slot.in_transaction():
+            begin_transaction(cu, slot, db_name)
+            return slot
+    return None
 
 
-def auto_commit_open():
-    NANO_SETTINGS["auto_commit"] = True
-    db_commit()
+def abort_write(slot):
+    # a failed write outside atomic() would keep its transaction open, and sqlite's write lock with it
+    if slot is not None and slot.auto_commit and not slot.savepoints:
+        if slot.in_transaction():
+            slot.cx.execute("rollback")
+        end_transaction(slot)
+        slot.committed()
 
 
 @mutex
-def execute_sql(cu, sql):
+def execute_sql(cu, sql, params=(), db_name=None):
+    began = None
     try:
-        cu.execute(sql)
+        began = begin_write(cu, sql, db_name)
+        if sql_hooks:
+            run_hooked(cu, lambda: cu.execute(sql, params), sql, params, db_name)
+        else:
+            cu.execute(sql, params)
     except Exception as e:
+        abort_write(began)
         print('---------- sql failed -----------')
         print(sql)
+        print(params)
         print('---------------------------------')
         raise e
 
 
+def decode_text(value):
+    # byte strings of python2 are stored as unicode
+    if isinstance(value, bytes) and not isinstance(value, unicode):
+        for encoding in ("gbk", "utf8"):
+            try:
+                return value.decode(encoding)
+            except UnicodeDecodeError:
+                pass
+    return value
+
+
+@mutex
+def execute_many(cu, sql, seq_of_params, db_name=None):
+    began = None
+    try:
+        began = begin_write(cu, sql, db_name)
+        if sql_hooks:
+            run_hooked(cu, lambda: cu.executemany(sql, seq_of_params), sql, seq_of_params, db_name)
+        else:
+            cu.executemany(sql, seq_of_params)
+    except Exception as e:
+        abort_write(began)
+        print('---------- sql failed -----------')
+        print(sql)
+        print('---------------------------------')
+        raise e
+
+
+def chunks(items, size):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def in_transaction(db_name=None):
+    # True while the current thread has uncommitted writes to db_name
+    slot = get_pool(db_name).slot()
+    return bool(slot.savepoints) or not slot.auto_commit or slot.in_transaction()
+
+
+class Router(object):
+    """
+    Picks the database of the queries of a model. Writes go to the db_name of
+    the model class, or to the current database. Reads go to the read_replicas
+    of that database in turn, unless the current thread is in a transaction
+    there and needs to read its own writes. Set a subclass with set_router().
+    """
+
+    def __init__(self):
+        self.counter = itertools.count()
+
+    def db_for_write(self, model_class):
+        return model_class._meta.db_name or NANO_SETTINGS["db_name"]
+
+    def db_for_read(self, model_class):
+        db_name = self.db_for_write(model_class)
+        replicas = NANO_SETTINGS["read_replicas"].get(db_name)
+        if not replicas or in_transaction(db_name):
+            return db_name
+        return replicas[next(self.counter) % len(replicas)]
+
+
+router = Router()
+
+
+def set_router(new_router):
+    global router
+    router = new_router
+
+
+# db_name -> schema name of the database when it is attached to another one
+schema_names = {}
+
+
+def schema_name(db_name):
+    with pools_lock:
+        return schema_names.setdefault(db_name, "nanodb%d" % len(schema_names))
+
+
+@mutex
+def attach_database(attached_db_name, db_name=None):
+    # make the tables of attached_db_name readable on the connection to db_name as `schema`.`table`
+    slot = get_pool(db_name).slot()
+    schema = schema_name(attached_db_name)
+    if schema not in slot.attached:
+        slot.cx.execute("attach database ? as %s" % schema, (attached_db_name,))
+        slot.attached.add(schema)
+    return schema
+
+
+class QueryCache(object):
+    """
+    LRU cache of query results, keyed by database, sql and parameters.
+    A write to a table drops the results read from it. A result read while
+    one of its tables was written is not stored, see generation().
+    """
+
+    def __init__(self):
+        self.lock = thread.allocate_lock()
+        self.results = OrderedDict()  # key -> (expire time or None, tables, rows)
+        self.table_keys = {}  # table name -> keys of its results
+        self.generations = {}  # table name -> count of its invalidations
+        self.clears = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            result = self.results.pop(key, None)
+            if result is None or (result[0] is not None and result[0] < timer()):
+                if result is not None:
+                    self._forget(key, result)
+                self.misses += 1
+                return None
+            self.results[key] = result
+            self.hits += 1
+            return result[2]
+
+    def generation(self, tables):
+        # taken before the query runs and passed to set()
+        with self.lock:
+            return (self.clears,) + tuple([self.generations.get(table, 0) for table in tables])
+
+    def set(self, key, tables, rows, ttl=None, generation=None):
+        with self.lock:
+            if generation is not None and generation != (self.clears,) + tuple([self.generations.get(table, 0) for table in tables]):
+                # a write was committed meanwhile, the rows may be older than it
+                return
+            old = self.results.pop(key, None)
+            if old is not None:
+                self._forget(key, old)
+            self.results[key] = (timer() + ttl if ttl else None, tables, rows)
+            for table in tables:
+                self.table_keys.setdefault(table, set()).add(key)
+            while len(self.results) > NANO_SETTINGS["query_cache_size"]:
+                old_key, old = self.results.popitem(last=False)
+                self._forget(old_key, old)
+
+    def _forget(self, key, result):
+        for table in result[1]:
+            keys = self.table_keys.get(table)
+            if keys:
+                keys.discard(key)
+
+    def invalidate(self, *tables):
+        with self.lock:
+            for table in tables:
+                self.generations[table] = self.generations.get(table, 0) + 1
+                for key in self.table_keys.pop(table, ()):
+                    result = self.results.pop(key, None)
+                    if result is not None:
+                        self._forget(key, result)
+
+    def clear(self):
+        with self.lock:
+            self.results.clear()
+            self.table_keys.clear()
+            self.clears += 1
+
+    def stats(self):
+        with self.lock:
+            return {"hits": self.hits, "misses": self.misses, "size": len(self.results)}
+
+
+query_cache = QueryCache()
+
+
+def table_written(table_name, db_name=None):
+    # drop the cached results of the table now, and again when the write is committed
+    query_cache.invalidate(table_name)
+    get_pool(db_name).slot().written_tables.add(table_name)
+
+
+# marks the saved value of a field left out by Query.only or Query.defer
+DEFERRED = object()
+
+# marks a foreign key whose related object is not loaded yet
+UNLOADED = object()
+
+
+class Session(object):
+    """
+    Identity map of a unit of work, used in a with block:
+
+        with Session():
+            a = Area.get(id=1)
+            assert Area.get(id=1) is a  # no query
+
+    Model.get(id=...) and foreign key loading look here first. The least
+    recently used objects are evicted beyond max_size, and writes to a
+    model drop the cached objects of that model.
+    """
+
+    local = threading.local()
+
+    def __init__(self, max_size=None):
+        self.max_size = max_size or NANO_SETTINGS["session_max_size"]
+        self.objects = OrderedDict()  # (model class, id) -> object
+        self.hits = 0
+        self.misses = 0
+
+    def __enter__(self):
+        stack = getattr(Session.local, "stack", None)
+        if stack is None:
+            stack = Session.local.stack = []
+        stack.append(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        Session.local.stack.remove(self)
+
+    @staticmethod
+    def current():
+        stack = getattr(Session.local, "stack", None)
+        return stack[-1] if stack else None
+
+    def get(self, model_class, rid):
+        key = (model_class, rid)
+        ob = self.objects.pop(key, None)
+        if ob is None:
+            self.misses += 1
+            return None
+        self.objects[key] = ob
+        self.hits += 1
+        return ob
+
+    def add(self, ob):
+        key = (ob.__class__, ob.id)
+        self.objects.pop(key, None)
+        self.objects[key] = ob
+        while len(self.objects) > self.max_size:
+            self.objects.popitem(last=False)
+
+    def discard(self, model_class, ids=None):
+        # drop the given ids of model_class, or all of its objects
+        if ids is None:
+            for key in [key for key in self.objects if key[0] is model_class]:
+                del self.objects[key]
+        else:
+            for rid in ids:
+                self.objects.pop((model_class, rid), None)
+
+    def clear(self):
+        self.objects.clear()
+
+
+class AsyncExecutor(object):
+    """
+    Runs nanorm calls in worker threads and returns asyncio futures, so the
+    event loop never waits for sqlite. The reads run in async_workers lanes of
+    one thread each, a call goes to the lane with the fewest calls pending, and
+    every lane thread has its own connection. The writes go to a single writer
+    thread one after another, as sqlite allows one writer at a time.
+    """
+
+    def __init__(self, max_workers=None):
+        assert asyncio is not None, 'the async api needs python 3'
+        self.lanes = [ThreadPoolExecutor(1) for _ in range(max_workers or NANO_SETTINGS["async_workers"])]
+        self.pending = [0] * len(self.lanes)
+        self.lock = thread.allocate_lock()
+        self.writer = ThreadPoolExecutor(1)
+
+    @staticmethod
+    def loop():
+        try:
+            return asyncio.get_running_loop()
+        except (AttributeError, RuntimeError):
+            # python < 3.7, or called outside of a coroutine
+            return asyncio.get_event_loop()
+
+    def lane(self):
+        # index of the lane with the fewest calls pending
+        with self.lock:
+            return self.pending.index(min(self.pending))
+
+    def run(self, func, *args, **kwargs):
+        return self.run_in_lane(self.lane(), func, *args, **kwargs)
+
+    def run_in_lane(self, lane, func, *args, **kwargs):
+        # calls run in the same lane use the same thread, e.g. to go on with a cursor
+        with self.lock:
+            self.pending[lane] += 1
+        future = self.loop().run_in_executor(self.lanes[lane], functools.partial(func, *args, **kwargs))
+        future.add_done_callback(functools.partial(self._done, lane))
+        return future
+
+    def _done(self, lane, future):
+        with self.lock:
+            self.pending[lane] -= 1
+
+    def write(self, func, *args, **kwargs):
+        # an atomic decorated func runs as one transaction in the writer thread
+        return self.loop().run_in_executor(self.writer, functools.partial(func, *args, **kwargs))
+
+    def shutdown(self, wait=True):
+        for lane in self.lanes:
+            lane.shutdown(wait)
+        self.writer.shutdown(wait)
+
+
+async_executor = None
+
+
+def get_async_executor():
+    global async_executor
+    if async_executor is None:
+        with pools_lock:
+            if async_executor is None:
+                async_executor = AsyncExecutor()
+    return async_executor
+
+
+def shutdown_async_executor(wait=True):
+    # the next async call starts a new executor, e.g. after async_workers is changed
+    global async_executor
+    with pools_lock:
+        executor, async_executor = async_executor, None
+    if executor is not None:
+        executor.shutdown(wait)
+
+
+if hasattr(datetime.datetime, "fromisoformat"):
+    # python 3.7+
+    parse_datetime = datetime.datetime.fromisoformat
+    parse_date = datetime.date.fromisoformat
+else:
+    def parse_datetime(value):
+        return datetime.datetime.strptime(value, '%Y-%m-%d %H:%M:%S.%f')
+
+    def parse_date(value):
+        return datetime.datetime.strptime(value, '%Y-%m-%d').date()
+
+if sys.version_info >= (3, 6):
+    def format_datetime(value):
+        return value.isoformat(" ", "microseconds")
+else:
+    def format_datetime(value):
+        return value.strftime('%Y-%m-%d %H:%M:%S.%f')
+
+
 class Field(object):
     field_type = ""
     field_level = 0
     default = None
+    name = None
+    index = False
+    unique = False
+    # False when to_python returns the value as it is, so rows skip the call
+    converts = True
+
+    def contribute(self, name):
+        self.name = name
+
+    def loaded(self, instance):
+        d = getattr(instance, "__dict__", None)
+        if d is None:
+            return hasattr(instance, self.name)
+        return self.name in d
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        # the instance value hides this method, so it is only called when there is none,
+        # e.g. for a field left out by Query.only or Query.defer
+        if instance._load_deferred() and self.name in instance.__dict__:
+            return instance.__dict__[self.name]
+        raise AttributeError("'%s' object has no attribute '%s'" % (owner.__name__, self.name))
 
     def field_sql(self, field_name):
         return '"%s" %s null' % (field_name, self.field_type)
 
+    def related_model(self, model_class):
+        return None
+
+    def to_python(self, value):
+        return None if value == 'None' else value
+
+    def to_db(self, value):
+        return value
+
 
 class CharField(Field):
-    def __init__(self, max_length=255, default=""):
+    def __init__(self, max_length=255, default="", index=False, unique=False):
         self.field_type = "varchar(%d)" % max_length
         self.default = default
         self.max_length = max_length
+        self.index = index
+        self.unique = unique
+
+    def to_db(self, value):
+        return decode_text(value)
 
 
 class IntegerField(Field):
-    def __init__(self, default=0):
+    converts = False
+
+    def __init__(self, default=0, index=False, unique=False):
         self.field_type = "integer"
         self.default = default
+        self.index = index
+        self.unique = unique
+
+    def to_python(self, value):
+        return value
 
 
 class FloatField(Field):
-    def __init__(self, default=0.0):
+    converts = False
+
+    def __init__(self, default=0.0, index=False, unique=False):
         self.field_type = "real"
         self.default = default
+        self.index = index
+        self.unique = unique
+
+    def to_python(self, value):
+        return value
 
 
 class BooleanField(Field):
-    def __init__(self, default=True):
+    def __init__(self, default=True, index=False, unique=False):
         self.field_type = "boolean"
         self.default = default
+        self.index = index
+        self.unique = unique
+
+    def to_python(self, value):
+        if value.__class__ is int:
+            return value == 1
+        # 兼容老版本
+        return value == 'True'
+
+    def to_db(self, value):
+        return 1 if value else 0
 
 
 class DateField(Field):
-    def __init__(self, default=None, auto_now_add=False, auto_now=False):
+    def __init__(self, default=None, auto_now_add=False, auto_now=False, index=False, unique=False):
         self.field_type = "date"
         self.default = default
         self.auto_now_add = auto_now_add
         self.auto_now = auto_now
+        self.index = index
+        self.unique = unique
+
+    def now(self):
+        return datetime.date.today()
+
+    def to_python(self, value):
+        if not value or value == 'None':
+            return None
+        return parse_date(value)
+
+    def to_db(self, value):
+        if isinstance(value, datetime.datetime):
+            value = value.date()
+        if isinstance(value, datetime.date):
+            return value.isoformat()
+        return value
 
 
 class DateTimeField(Field):
-    def __init__(self, default=None, auto_now_add=False, auto_now=False):
+    def __init__(self, default=None, auto_now_add=False, auto_now=False, index=False, unique=False):
         self.field_type = "datetime"
         self.default = default
         self.auto_now_add = auto_now_add
         self.auto_now = auto_now
+        self.index = index
+        self.unique = unique
 
+    def now(self):
+        return datetime.datetime.now()
 
-class ForeignKey(Field):
-    def __init__(self, model_class):
+    def to_python(self, value):
+        if not value or value == 'None':
+            return None
+        return parse_datetime(value)
+
+    def to_db(self, value):
+        if isinstance(value, datetime.datetime):
+            return format_datetime(value)
+        return value
+
+
+class RelatedField(Field):
+    """
+    Base of ForeignKey and SelfForeignKey. The instance keeps the raw id,
+    the related object is loaded on first access and cached on the instance.
+    """
+    field_level = 1
+
+    def contribute(self, name):
+        self.name = name
+        self.id_name = "_%s_id" % name
+        self.cache_name = "_%s_cache" % name
+
+    def loaded(self, instance):
+        return hasattr(instance, self.id_name)
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        ob = getattr(instance, self.cache_name, UNLOADED)
+        if ob is not UNLOADED:
+            return ob
+        fid = getattr(instance, self.id_name, DEFERRED)
+        if fid is DEFERRED:
+            instance._load_deferred()
+            fid = getattr(instance, self.id_name)
+        ob = self.related_model(instance.__class__).get(id=fid) if fid else None
+        setattr(instance, self.cache_name, ob)
+        return ob
+
+    def __set__(self, instance, value):
+        if isinstance(value, Model):
+            setattr(instance, self.id_name, value.id)
+            setattr(instance, self.cache_name, value)
+        else:
+            setattr(instance, self.id_name, value)
+            setattr(instance, self.cache_name, UNLOADED)
+
+    def get_id(self, instance):
+        ob = getattr(instance, self.cache_name, None)
+        if ob is not None and ob is not UNLOADED:
+            return ob.id
+        fid = getattr(instance, self.id_name, DEFERRED)
+        if fid is DEFERRED:
+            instance._load_deferred()
+            fid = getattr(instance, self.id_name)
+        return fid
+
+    def cache(self, instance, ob):
+        # set the loaded related object, the raw id is kept as it is
+        setattr(instance, self.cache_name, ob)
+
+    def to_db(self, value):
+        return value.id if isinstance(value, Model) else value
+
+
+class RelatedId(object):
+    """
+    The <field>_id accessor of a foreign key, it never queries.
+    """
+
+    def __init__(self, field):
+        self.field = field
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        return self.field.get_id(instance)
+
+    def __set__(self, instance, value):
+        self.field.__set__(instance, value)
+
+
+class ForeignKey(RelatedField):
+    def __init__(self, model_class, related_name=None, index=True):
         self.field_type = "foreignkey"
-        self.field_level = 1
         self.model_class = model_class
+        self.related_name = related_name
+        self.index = index
 
     def field_sql(self, field_name):
         foreign_to = self.model_class.__name__.lower()
         return '"%s" integer NULL REFERENCES "%s" ("id")' % (field_name, foreign_to)
 
+    def related_model(self, model_class):
+        return self.model_class
 
-class SelfForeignKey(Field):
-    def __init__(self):
+
+class SelfForeignKey(RelatedField):
+    def __init__(self, related_name=None, index=True):
         self.field_type = "selfforeignkey"
-        self.field_level = 1
+        self.related_name = related_name
+        self.index = index
 
     def field_sql(self, field_name, model_class):
         foreign_to = model_class.__name__.lower()
         return '"%s" integer NULL REFERENCES "%s" ("id")' % (field_name, foreign_to)
 
+    def related_model(self, model_class):
+        return model_class
+
+
+class ModelMeta(object):
+    """
+    Compiled metadata of a model class, built once when the class is created.
+    Fields keep the dir() order, which is also the column order of the table.
+    Indexes come from the index/unique options of the fields and from the
+    index_together/unique_together lists of field names of the model class.
+    The table lives in the database db_name of the model class, None for the
+    current database.
+    """
+
+    def __init__(self, model_class):
+        self.model_class = model_class
+        self.table_name = model_class.__name__.lower()
+        self.field_names = []
+        self.fields = []
+        fields = dict(getattr(model_class, "compact_fields", {}))
+        for name in dir(model_class):
+            var = getattr(model_class, name)
+            if isinstance(var, Field):
+                fields[name] = var
+        for name in sorted(fields):
+            assert name.lower() not in ('op', 'id', 'key', 'in', 'is', 'like'), 'field name should not be `%s`' % name
+            self.field_names.append(name)
+            self.fields.append(fields[name])
+        self.compact = bool(getattr(model_class, "compact", False))
+        self.db_name = getattr(model_class, "db_name", None)
+        self.field_map = dict(zip(self.field_names, self.fields))
+        self.columns = ["`%s`" % name for name in self.field_names]
+        self.columns_sql = ", ".join(self.columns)
+        self.select_sql = self.qualified_columns_sql("`%s`" % self.table_name)
+        self.related = [field.related_model(model_class) for field in self.fields]
+        self.reverse = {}  # related name -> (model class, field name) of the foreign keys to this model
+        self.auto_now = [getattr(field, 'auto_now', False) for field in self.fields]
+        self.auto_now_indexes = [i for i, auto_now in enumerate(self.auto_now) if auto_now]
+        self.converters = [field.to_python for field in self.fields]
+        # None where the db value is used as it is
+        self.row_converters = [field.to_python if field.converts else None for field in self.fields]
+        self.row_class = namedtuple("%sRow" % model_class.__name__, ["id"] + self.field_names, rename=True)
+
+        fields_sql = ""
+        for name, field in zip(self.field_names, self.fields):
+            if isinstance(field, SelfForeignKey):
+                field_sql = field.field_sql(name, model_class)
+            else:
+                field_sql = field.field_sql(name)
+            fields_sql += ", " + field_sql
+        self.create_sql = 'create table `%s` ( "id" integer not null primary key autoincrement %s );' % (self.table_name, fields_sql)
+
+        indexes = []
+        for name, field in zip(self.field_names, self.fields):
+            if field.unique:
+                indexes.append(((name,), True))
+            elif field.index:
+                indexes.append(((name,), False))
+        indexes += [(tuple(names), False) for names in getattr(model_class, "index_together", ())]
+        indexes += [(tuple(names), True) for names in getattr(model_class, "unique_together", ())]
+        self.index_sqls = []
+        for names, unique in indexes:
+            for name in names:
+                assert name in self.field_map, 'no field named `%s` to index' % name
+            index_name = "%s_%s_%s" % ("uniq" if unique else "idx", self.table_name, "_".join(names))
+            self.index_sqls.append('create %sindex if not exists "%s" on `%s` (%s);' % (
+                "unique " if unique else "", index_name, self.table_name, ", ".join(["`%s`" % name for name in names])))
+
+        # statements only depend on the model, values are bound as parameters
+        self.insert_sql = "insert into `%s`(%s) values(%s)" % (
+            self.table_name, self.columns_sql, ", ".join(["?"] * len(self.columns)))
+        self.update_sql = "update `%s` set %s where id = ?" % (
+            self.table_name, ", ".join(["%s=?" % column for column in self.columns]))
+        self.delete_sql = "delete from `%s` where id = ?" % self.table_name
+        self.update_sqls = {}
+
+    def qualified_columns_sql(self, alias):
+        return ", ".join(["%s.`%s`" % (alias, name) for name in ["id"] + self.field_names])
+
+    def update_sql_for(self, indexes):
+        # update statement of the given field indexes, cached by shape
+        sql = self.update_sqls.get(indexes)
+        if sql is None:
+            sql = "update `%s` set %s where id = ?" % (
+                self.table_name, ", ".join(["%s=?" % self.columns[i] for i in indexes]))
+            self.update_sqls[indexes] = sql
+        return sql
+
 
-class Model(object):
+class ModelBase(type):
+    """
+    Metaclass of Model, compiles the ModelMeta of each model class.
+
+    A model class with compact = True gets __slots__ for its values instead of
+    a __dict__ per instance, which saves memory for large result sets. Its plain
+    fields are kept in compact_fields instead of class attributes, and it does
+    not support Query.only and Query.defer.
+    """
+
+    def __new__(mcs, name, bases, attrs):
+        if attrs.get("compact"):
+            compact_fields = {}
+            for base in bases:
+                compact_fields.update(getattr(base, "compact_fields", {}))
+            slots = ["id", "_saved_values", "_prefetched"]
+            for attr, value in list(attrs.items()):
+                if isinstance(value, RelatedField):
+                    slots += ["_%s_id" % attr, "_%s_cache" % attr]
+                elif isinstance(value, Field):
+                    compact_fields[attr] = attrs.pop(attr)
+            slots += sorted(compact_fields)
+            attrs["compact_fields"] = compact_fields
+            attrs["__slots__"] = tuple(slots)
+        return super(ModelBase, mcs).__new__(mcs, name, bases, attrs)
+
+    def __init__(cls, name, bases, attrs):
+        super(ModelBase, cls).__init__(name, bases, attrs)
+        cls._meta = ModelMeta(cls)
+        cls.table_name = cls._meta.table_name
+        for field_name, field, related in zip(cls._meta.field_names, cls._meta.fields, cls._meta.related):
+            field.contribute(field_name)
+            if related is not None:
+                if not hasattr(cls, field_name + "_id"):
+                    setattr(cls, field_name + "_id", RelatedId(field))
+                related_name = field.related_name or "%s_set" % cls._meta.table_name
+                other = related._meta.reverse.get(related_name)
+                # a model class defined again, e.g. on reload, takes over its own name
+                own = other is not None and (other[0].table_name, other[1]) == (cls.table_name, field_name)
+                taken = other is not None or related_name in related._meta.field_map or hasattr(related, related_name)
+                if taken and not own:
+                    # a default name is left out, e.g. for the second foreign key to the same model
+                    assert field.related_name is None, '`%s` of %s is taken, set another related_name of %s.%s' % (
+                        related_name, related.__name__, name, field_name)
+                    continue
+                related._meta.reverse[related_name] = (cls, field_name)
+                setattr(related, related_name, ReverseRelation(cls, field_name, related_name))
+
+
+class ReverseRelation(object):
+    """
+    The objects whose foreign key points to an instance, e.g. area.user_set
+    """
+
+    def __init__(self, model_class, field_name, related_name):
+        self.model_class = model_class
+        self.field_name = field_name
+        self.related_name = related_name
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        prefetched = getattr(instance, "_prefetched", None)
+        if prefetched and self.related_name in prefetched:
+            return prefetched[self.related_name]
+        return self.model_class.query().filter(**{self.field_name: instance.id}).all()
+
+
+def prefetch_related_objects(objs, *paths):
+    # load the related objects of objs with one `in` query per relation and chunk of ids
+    objs = list(objs)
+    for path in paths:
+        _prefetch(objs, path.split("__"))
+    return objs
+
+
+def _prefetch(objs, names):
+    if not objs:
+        return
+    meta = objs[0]._meta
+    name = names[0]
+    if name in meta.field_map:
+        field = meta.field_map[name]
+        related = meta.related[meta.field_names.index(name)]
+        assert related is not None, '`%s` is not a foreign key' % name
+        fids = [field.get_id(ob) for ob in objs]
+        found = dict((r.id, r) for r in related.query()._in_chunks("id", set(fid for fid in fids if fid)))
+        for ob, fid in zip(objs, fids):
+            field.cache(ob, found.get(fid))
+        loaded = list(found.values())
+    else:
+        assert name in meta.reverse, 'no relation named `%s` in %s' % (name, objs[0].__class__.__name__)
+        model_class, field_name = meta.reverse[name]
+        field = model_class._meta.field_map[field_name]
+        parents = dict((ob.id, ob) for ob in objs)
+        children = dict((ob.id, []) for ob in objs)
+        loaded = []
+        for child in model_class.query()._in_chunks(field_name, list(parents)):
+            fid = field.get_id(child)
+            field.cache(child, parents[fid])
+            children[fid].append(child)
+            loaded.append(child)
+        for ob in objs:
+            if getattr(ob, "_prefetched", None) is None:
+                ob._prefetched = {}
+            ob._prefetched[name] = children[ob.id]
+    if len(names) > 1:
+        _prefetch(loaded, names[1:])
+
+
+class Model(ModelBase("NanoModel", (object,), {"__slots__": ()})):
+    __slots__ = ()
 
     def __init__(self, rid=0, **kwargs):
         self.__class__.try_create_table()
-        self.table_name = self.__class__.__name__.lower()
         self.id = rid
-        for name in self.field_names:
-            assert name.lower() not in ('op', 'id', 'key', 'in', 'is', 'like'), 'field name should not be `%s`' % name
-            field = getattr(self.__class__, name.replace("`", ""))
+        # db values of the last load or save, to find the changed fields
+        self._saved_values = None
+        meta = self._meta
+        for name, field in zip(meta.field_names, meta.fields):
             value = field.default
             if isinstance(field, DateTimeField) and field.auto_now_add:
                 value = datetime.datetime.now()
@@ -203,7 +1515,7 @@ class Model(object):
                 value = datetime.date.today()
             if callable(value):
                 value = value()
-            setattr(self, name.replace("`", ""), value)
+            setattr(self, name, value)
         for key, value in kwargs.items():
             setattr(self, key.replace("`", ""), value)
 
@@ -224,94 +1536,106 @@ class Model(object):
 
     @property
     def field_names(self):
-        names = []
-        for name in dir(self.__class__):
-            var = getattr(self.__class__, name.replace("`", ""))
-            if isinstance(var, Field):
-                names.append("`%s`" % name)
-        return names
-
-    @property
-    def field_values(self):
+        return self._meta.columns
+
+    def _load_deferred(self):
+        # load the deferred fields with one query, fields set meanwhile are kept
+        saved = getattr(self, "_saved_values", None)
+        if saved is None:
+            return False
+        indexes = [i for i, value in enumerate(saved) if value is DEFERRED]
+        if not indexes:
+            return False
+        meta = self._meta
+        columns_sql = ", ".join([meta.columns[i] for i in indexes])
+        db_name = router.db_for_read(self.__class__)
+        cu = get_cursor(db_name=db_name)
+        execute_sql(cu, "select %s from `%s` where id = ?;" % (columns_sql, meta.table_name), (self.id,), db_name=db_name)
+        r = cu.fetchone()
+        assert r is not None, '%s is deleted' % self
+        saved = list(saved)
+        for i, value in zip(indexes, r):
+            field = meta.fields[i]
+            if not field.loaded(self):
+                setattr(self, field.name, meta.converters[i](value))
+            saved[i] = value
+        self._saved_values = saved
+        return True
+
+    def _db_values(self, touch=True):
         values = []
-        for name in self.field_names:
-            name = name.replace("`", "")
-            value = getattr(self, name)
-            field = getattr(self.__class__, name)
-
-            is_string = True
-
-            if isinstance(value, (str, unicode)):
-                value = value.replace("'", "''")
-                try:
-                    value = value.decode("gbk")
-                except Exception as e:
-                    pass
-                try:
-                    value = value.decode("utf8")
-                except Exception as e:
-                    pass
-
-            if isinstance(value, Model):
-                value = value.id
-                is_string = False
-            
-            if isinstance(field, DateTimeField) and field.auto_now:
-                value = datetime.datetime.now()
-                setattr(self, name.replace("`", ""), value)
-            
-            if isinstance(field, DateField) and field.auto_now:
-                value = datetime.date.today()
-                setattr(self, name.replace("`", ""), value)
-            
-            if isinstance(field, BooleanField):
-                value = 'true' if value else 'false'
-                is_string = False
-
-            if isinstance(field, (IntegerField,FloatField)):
-                is_string = False 
-
-            if field.field_type == 'datetime' and value:
-                value = value.strftime('%Y-%m-%d %H:%M:%S.%f')
-
-            if field.field_type == 'date' and value:
-                value = value.strftime('%Y-%m-%d')
-            
-            if field.field_type == 'selfforeignkey' and value:
-                assert self.id != value, 'SelfForeignKey can not set the self instance!'
-
-            if is_string:
-                values.append("'%s'" % value)
+        meta = self._meta
+        saved = self._saved_values
+        for i, (name, field, auto_now) in enumerate(zip(meta.field_names, meta.fields, meta.auto_now)):
+            if saved is not None and saved[i] is DEFERRED and not field.loaded(self):
+                # not loaded and not set, so unchanged
+                values.append(DEFERRED)
+                continue
+            if auto_now and touch:
+                value = field.now()
+                setattr(self, name, value)
+            elif field.field_level == 1:
+                value = field.get_id(self)
             else:
-                values.append(str(value))
-
-        return values
+                value = getattr(self, name)
 
-    def insert(self):
-        cu = get_cursor()
+            if field.field_type == 'selfforeignkey':
+                assert getattr(self, field.cache_name, None) is not self and not (value and value == self.id), 'SelfForeignKey can not set the self instance!'
 
-        field_names_sql = ", ".join(self.field_names)
-        field_values_sql = ", ".join(self.field_values)
+            values.append(field.to_db(value))
 
-        sql = "insert into `%s`(%s) values(%s)" % (self.table_name, field_names_sql, field_values_sql)
-        execute_sql(cu, sql)
-        db_commit()
+        return values
 
-        sql = "select id from `%s` order by id desc;" % self.table_name
-        execute_sql(cu, sql)
-        self.id = cu.fetchone()[0]
+    @property
+    def field_values(self):
+        return self._db_values()
 
-    def update(self):
-        cu = get_cursor()
+    @property
+    def changed_fields(self):
+        meta = self._meta
+        if self._saved_values is None:
+            return list(meta.field_names)
+        values = self._db_values(touch=False)
+        return [name for name, value, saved in zip(meta.field_names, values, self._saved_values) if value != saved]
 
-        name_value = []
-        for name, value in zip(self.field_names, self.field_values):
-            name_value.append("%s=%s" % (name, value))
-        name_value_sql = ", ".join(name_value)
+    def insert(self):
+        db_name = router.db_for_write(self.__class__)
+        cu = get_cursor(db_name=db_name)
+        values = self.field_values
+        execute_sql(cu, self._meta.insert_sql, values, db_name=db_name)
+        self.id = cu.lastrowid
+        self._saved_values = values
+        table_written(self.table_name, db_name)
+        db_commit(db_name=db_name)
+        session = Session.current()
+        if session is not None:
+            session.add(self)
 
-        sql = "update `%s` set %s where id = %d" % (self.table_name, name_value_sql, self.id)
-        execute_sql(cu, sql)
-        db_commit()
+    def update(self):
+        meta = self._meta
+        values = self._db_values(touch=False)
+        if self._saved_values is None:
+            indexes = range(len(values))
+        else:
+            indexes = [i for i, (value, saved) in enumerate(zip(values, self._saved_values)) if value != saved]
+            if not indexes:
+                return
+            indexes = sorted(set(indexes).union(meta.auto_now_indexes))
+        for i in meta.auto_now_indexes:
+            field = meta.fields[i]
+            value = field.now()
+            setattr(self, meta.field_names[i], value)
+            values[i] = field.to_db(value)
+
+        db_name = router.db_for_write(self.__class__)
+        cu = get_cursor(db_name=db_name)
+        execute_sql(cu, meta.update_sql_for(tuple(indexes)), [values[i] for i in indexes] + [self.id], db_name=db_name)
+        self._saved_values = values
+        table_written(self.table_name, db_name)
+        db_commit(db_name=db_name)
+        session = Session.current()
+        if session is not None:
+            session.add(self)
 
     def save(self):
         if self.id:
@@ -321,40 +1645,119 @@ class Model(object):
         return self
 
     def delete(self):
-        cu = get_cursor()
-        sql = "delete from `%s` where id = %d" % (self.table_name, self.id)
-        execute_sql(cu, sql)
-        db_commit()
+        db_name = router.db_for_write(self.__class__)
+        cu = get_cursor(db_name=db_name)
+        execute_sql(cu, self._meta.delete_sql, (self.id,), db_name=db_name)
+        table_written(self.table_name, db_name)
+        db_commit(db_name=db_name)
+        session = Session.current()
+        if session is not None:
+            session.discard(self.__class__, [self.id])
+
+    def asave(self):
+        return get_async_executor().write(self.save)
+
+    def adelete(self):
+        return get_async_executor().write(self.delete)
+
+    @classmethod
+    def bulk_insert(cls, objs, batch_size=500):
+        # insert unsaved objects with one executemany and one transaction per batch
+        objs = list(objs)
+        meta = cls._meta
+        db_name = router.db_for_write(cls)
+        cu = get_cursor(db_name=db_name)
+        for batch in chunks(objs, batch_size):
+            for ob in batch:
+                assert isinstance(ob, cls) and not ob.id, 'bulk_insert only accepts unsaved %s instances' % cls.__name__
+            rows = [ob.field_values for ob in batch]
+            # a failed batch is rolled back, the batch is one transaction so its ids are consecutive
+            with atomic(db_name=db_name):
+                execute_many(cu, meta.insert_sql, rows, db_name=db_name)
+                execute_sql(cu, "select last_insert_rowid();", db_name=db_name)
+                last_id = cu.fetchone()[0]
+                table_written(meta.table_name, db_name)
+            for i, ob in enumerate(batch):
+                ob.id = last_id - len(batch) + 1 + i
+                ob._saved_values = rows[i]
+        return objs
+
+    @classmethod
+    def bulk_save(cls, objs, batch_size=500):
+        # insert the unsaved objects and update the saved ones
+        objs = list(objs)
+        saved = [ob for ob in objs if ob.id]
+        cls.bulk_insert([ob for ob in objs if not ob.id], batch_size)
+        meta = cls._meta
+        db_name = router.db_for_write(cls)
+        cu = get_cursor(db_name=db_name)
+        for batch in chunks(saved, batch_size):
+            for ob in batch:
+                # every column is written, so load the ones left out by only/defer
+                ob._load_deferred()
+            rows = [ob.field_values for ob in batch]
+            with atomic(db_name=db_name):
+                execute_many(cu, meta.update_sql, [values + [ob.id] for ob, values in zip(batch, rows)], db_name=db_name)
+                table_written(meta.table_name, db_name)
+            for ob, values in zip(batch, rows):
+                ob._saved_values = values
+        session = Session.current()
+        if session is not None:
+            session.discard(cls, [ob.id for ob in saved])
+        return objs
+
+    @classmethod
+    def migrate_legacy_values(cls):
+        """
+        Rewrite the values stored by old versions: 'None' strings become null and
+        'True'/'False' strings of boolean fields become 1/0. Returns the changed cells.
+        """
+        meta = cls._meta
+        cls.try_create_table()
+        db_name = router.db_for_write(cls)
+        cu = get_cursor(db_name=db_name)
+        changed = 0
+        for column, field in zip(meta.columns, meta.fields):
+            if field.field_type == "boolean":
+                updates = [("1", "'True'"), ("0", "'False'")]
+            else:
+                updates = [("null", "'None'")]
+            for new, old in updates:
+                execute_sql(cu, "update `%s` set %s = %s where %s = %s;" % (meta.table_name, column, new, column, old), db_name=db_name)
+                changed += cu.rowcount
+        table_written(meta.table_name, db_name)
+        db_commit(db_name=db_name)
+        return changed
 
     def refresh(self):
         assert self.id, 'only saved instance can be refreshed'
-        return self.__class__.get(id=self.id)
+        ob = Query(self.__class__).filter(id=self.id).first()
+        session = Session.current()
+        if session is not None and ob is not None:
+            session.add(ob)
+        return ob
 
     @classmethod
-    def try_create_table(cls):
-        table_name = cls.__name__.lower()
-
-        cu = get_cursor()
-        sql = "select * from sqlite_master where type='table' AND name='%s';" % table_name
-        execute_sql(cu, sql)
+    def try_create_table(cls, force=False):
+        table_name = cls._meta.table_name
+        db_name = router.db_for_write(cls)
+        tables = known_tables.setdefault(db_name, set())
+        if table_name in tables and not force:
+            return
+
+        cu = get_cursor(db_name=db_name)
+        sql = "select * from sqlite_master where type='table' AND name=?;"
+        execute_sql(cu, sql, (table_name,), db_name=db_name)
         if not cu.fetchall():
             sql = "drop table if exists `%s`;" % table_name
-            execute_sql(cu, sql)
-
-            fields_sql = ""
-            for name in dir(cls):
-                var = getattr(cls, name.replace("`", ""))
-                if isinstance(var, Field):
-                    field = var
-                    if isinstance(field, SelfForeignKey):
-                        field_sql = field.field_sql(name, cls)
-                    else:
-                        field_sql = field.field_sql(name)
-                    fields_sql += ", " + field_sql
-            sql = 'create table `%s` ( "id" integer not null primary key autoincrement %s );' % (table_name, fields_sql)
-            execute_sql(cu, sql)
-
-            db_commit()
+            execute_sql(cu, sql, db_name=db_name)
+            execute_sql(cu, cls._meta.create_sql, db_name=db_name)
+
+        # also adds the indexes declared after the table was created
+        for sql in cls._meta.index_sqls:
+            execute_sql(cu, sql, db_name=db_name)
+        db_commit(db_name=db_name)
+        tables.add(table_name)
 
     @classmethod
     def query(cls):
@@ -368,19 +1771,190 @@ class Model(object):
 
     @classmethod
     def get(cls, **kwargs):
-        query = Query(cls)
-        return query.filter(**kwargs).first()
+        session = Session.current()
+        if session is None or list(kwargs) != ["id"]:
+            query = Query(cls)
+            return query.filter(**kwargs).first()
+
+        rid = kwargs["id"]
+        rid = rid.id if isinstance(rid, Model) else rid
+        ob = session.get(cls, rid)
+        if ob is None:
+            ob = Query(cls).filter(id=rid).first()
+            if ob is not None:
+                session.add(ob)
+        return ob
+
+    @classmethod
+    def in_bulk(cls, ids):
+        # id -> object of the ids found, with one `in` query per max_variables ids
+        ids = set(rid.id if isinstance(rid, Model) else rid for rid in ids)
+        found = {}
+        session = Session.current()
+        if session is not None:
+            for rid in ids:
+                ob = session.get(cls, rid)
+                if ob is not None:
+                    found[rid] = ob
+        for ob in Query(cls)._in_chunks("id", ids.difference(found)):
+            found[ob.id] = ob
+            if session is not None:
+                session.add(ob)
+        return found
+
+    @classmethod
+    def aget(cls, **kwargs):
+        return get_async_executor().run(cls.get, **kwargs)
+
+
+class Aggregate(object):
+    """
+    An sql aggregate function of a field, for Query.aggregate and Query.group_by
+    """
+    function = ""
+    # min and max give a value of the field itself
+    convert = False
+
+    def __init__(self, field_name="id"):
+        self.field_name = field_name
+
+    def sql(self, model_class):
+        meta = model_class._meta
+        assert self.field_name == "id" or self.field_name in meta.field_map, 'no field named `%s`' % self.field_name
+        return "%s(`%s`.`%s`)" % (self.function, meta.table_name, self.field_name)
+
+    def to_python(self, model_class, value):
+        if self.convert and self.field_name != "id":
+            return model_class._meta.field_map[self.field_name].to_python(value)
+        return value
+
+
+class Count(Aggregate):
+    function = "count"
+
+    def __init__(self, field_name=None):
+        self.field_name = field_name
+
+    def sql(self, model_class):
+        if self.field_name is None:
+            return "count(*)"
+        return Aggregate.sql(self, model_class)
+
+
+class Sum(Aggregate):
+    function = "sum"
+
+
+class Avg(Aggregate):
+    function = "avg"
+
+
+class Min(Aggregate):
+    function = "min"
+    convert = True
+
+
+class Max(Aggregate):
+    function = "max"
+    convert = True
+
+
+class AsyncQueryIterator(object):
+    """
+    Target of `async for ob in query`, fetches chunk_size objects per call to a worker thread.
+    All the calls go to one lane of the executor, the thread whose connection runs the cursor.
+    """
+
+    def __init__(self, query, chunk_size=100):
+        self.iterator = query.iterator(chunk_size)
+        self.chunk_size = chunk_size
+        self.objs = deque()
+        self.done = False
+        self.executor = None
+        self.lane = None
+        self.thread_id = None
+
+    def __aiter__(self):
+        return self
+
+    def _fetch(self):
+        assert self.thread_id in (None, thread.get_ident()), 'the cursor moved to another thread'
+        self.thread_id = thread.get_ident()
+        objs = list(itertools.islice(self.iterator, self.chunk_size))
+        if len(objs) < self.chunk_size:
+            self.done = True
+        return objs
+
+    def __anext__(self):
+        if self.executor is None:
+            self.executor = get_async_executor()
+            self.lane = self.executor.lane()
+        result = self.executor.loop().create_future()
+        if self.objs:
+            result.set_result(self.objs.popleft())
+        elif self.done:
+            result.set_exception(StopAsyncIteration())
+        else:
+            self.executor.run_in_lane(self.lane, self._fetch).add_done_callback(functools.partial(self._fetched, result))
+        return result
+
+    def _fetched(self, result, future):
+        if result.cancelled():
+            return
+        if future.cancelled():
+            result.cancel()
+        elif future.exception() is not None:
+            result.set_exception(future.exception())
+        elif future.result():
+            self.objs.extend(future.result())
+            result.set_result(self.objs.popleft())
+        else:
+            result.set_exception(StopAsyncIteration())
+
+
+# lookups of filter(), e.g. filter(age__gte=18) -> sql operator
+LOOKUPS = {
+    "exact": "=", "ne": "!=", "gt": ">", "gte": ">=", "lt": "<", "lte": "<=",
+    "in": "in", "isnull": "is null", "contains": "like", "startswith": "like", "endswith": "like",
+}
+
+
+def like_escape(value):
+    return value.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+
+class RelatedJoin(object):
+    """
+    A model loaded by select_related, its columns start at offset of the joined row.
+    """
+
+    def __init__(self, model_class, alias, offset):
+        self.model_class = model_class
+        self.alias = alias
+        self.offset = offset
+        self.children = {}  # field index -> RelatedJoin
 
 
 class Query(object):
 
-    def __init__(self, model_class, where_sql='1=1', order_sql='', limit_sql=''):
+    def __init__(self, model_class, where_sql='1=1', order_sql='', limit_sql='', params=()):
         model_class.try_create_table()
         self.model_class = model_class
-        self.table_name = self.model_class.__name__
+        self.table_name = model_class._meta.table_name
         self.where_sql = where_sql
         self.order_sql = order_sql
         self.limit_sql = limit_sql
+        self.params = tuple(params)
+        self.related_paths = ()
+        self._related_join = None
+        self.prefetch_paths = ()
+        self.loaded_indexes = None  # field indexes selected by only/defer
+        self.use_cache = None  # None follows the query_cache setting
+        self.cache_ttl = None
+        self.db_name = None  # None lets the router pick the database
+        self.limit_count = None  # None for no limit
+        self.offset_count = 0
+        self.order_field = None  # (field name, descending) set by order()
 
     def __str__(self):
         return "%s_%s_%s" % (self.__class__.__name__, self.table_name, self.query_sql)
@@ -393,148 +1967,608 @@ class Query(object):
 
     @property
     def field_names(self):
-        names = []
-        for name in dir(self.model_class):
-            var = getattr(self.model_class, name.replace("`", ""))
-            if isinstance(var, Field):
-                names.append("`%s`" % name)
-        return names
+        return self.model_class._meta.columns
 
     @property
     def query_sql(self):
-        sql = "select * from `%s` where %s %s %s;" % (self.table_name, self.where_sql, self.order_sql, self.limit_sql)
+        if self.loaded_indexes is not None:
+            assert not self.related_paths, 'only/defer can not be used with select_related'
+            meta = self.model_class._meta
+            columns_sql = ", ".join(["`%s`.`id`" % self.table_name] + ["`%s`.%s" % (self.table_name, meta.columns[i]) for i in self.loaded_indexes])
+            sql = "select %s from `%s` where %s %s %s;" % (columns_sql, self.table_name, self.where_sql, self.order_sql, self.limit_sql)
+        elif self.related_paths:
+            select_sql, join_sql = self._compile_related()
+            sql = "select %s from `%s` %s where %s %s %s;" % (select_sql, self.table_name, join_sql, self.where_sql, self.order_sql, self.limit_sql)
+        else:
+            sql = "select %s from `%s` where %s %s %s;" % (self.model_class._meta.select_sql, self.table_name, self.where_sql, self.order_sql, self.limit_sql)
         return sql
 
+    def _compile_related(self):
+        # left join the related tables of select_related
+        meta = self.model_class._meta
+        root = RelatedJoin(self.model_class, "`%s`" % self.table_name, 0)
+        select_sql = [meta.select_sql]
+        join_sql = []
+        offset = 1 + len(meta.fields)
+        for path in self.related_paths:
+            node = root
+            for name in path:
+                meta = node.model_class._meta
+                assert name in meta.field_map, 'no field named `%s` in %s' % (name, node.model_class.__name__)
+                i = meta.field_names.index(name)
+                related = meta.related[i]
+                assert related is not None, '`%s` is not a foreign key' % name
+                child = node.children.get(i)
+                if child is None:
+                    related.try_create_table()
+                    alias = "t%d" % (len(join_sql) + 1)
+                    child = RelatedJoin(related, alias, offset)
+                    node.children[i] = child
+                    select_sql.append(related._meta.qualified_columns_sql(alias))
+                    join_sql.append("left join %s %s on %s.`id` = %s.`%s`" % (
+                        self._table_sql(related), alias, alias, node.alias, name))
+                    offset += 1 + len(related._meta.fields)
+                node = child
+        self._related_join = root
+        return ", ".join(select_sql), " ".join(join_sql)
+
+    def _related_paths(self, model_class, depth):
+        paths = []
+        if depth > 0:
+            meta = model_class._meta
+            for name, related in zip(meta.field_names, meta.related):
+                if related is not None:
+                    paths.append((name,))
+                    paths.extend([(name,) + path for path in self._related_paths(related, depth - 1)])
+        return paths
+
+    def select_related(self, *fields, **kwargs):
+        """
+        Load the foreign keys in the same sql with left join, e.g. select_related('area', 'leader__area').
+        Without fields, all the foreign keys are followed up to depth levels.
+        """
+        if fields:
+            paths = [tuple(field.split("__")) for field in fields]
+        else:
+            depth = kwargs.get("depth", NANO_SETTINGS["select_related_depth"])
+            paths = self._related_paths(self.model_class, depth)
+        return self._clone(related_paths=self.related_paths + tuple(paths), _related_join=None)
+
+    def prefetch_related(self, *fields):
+        """
+        Load the related objects with one `in` query per relation after the query runs,
+        fields are foreign keys or reverse relations, e.g. prefetch_related('area', 'user_set').
+        """
+        return self._clone(prefetch_paths=self.prefetch_paths + fields)
+
+    def _in_chunks(self, name, values):
+        # yield the objects whose `name` is in values, with one query per max_variables values
+        values = list(values)
+        size = NANO_SETTINGS["max_variables"] - len(self.params)
+        for chunk in chunks(values, size):
+            where_sql = self.where_sql + " and `%s`.`%s` in (%s)" % (self.table_name, name, ", ".join(["?"] * len(chunk)))
+            for ob in self._clone(where_sql=where_sql, params=self.params + tuple(chunk)).all():
+                yield ob
+
+    def cache(self, ttl=None, enabled=True):
+        # cache the results of this query, for ttl seconds or until its tables are written
+        return self._clone(use_cache=enabled, cache_ttl=ttl)
+
+    def using(self, db_name):
+        # run the query on db_name instead of the database picked by the router
+        return self._clone(db_name=db_name)
+
+    def _read_db(self):
+        return self.db_name or router.db_for_read(self.model_class)
+
+    def _write_db(self):
+        return self.db_name or router.db_for_write(self.model_class)
+
+    def _related_models(self):
+        models = []
+        for path in self.related_paths:
+            model_class = self.model_class
+            for name in path:
+                meta = model_class._meta
+                model_class = meta.related[meta.field_names.index(name)]
+                models.append(model_class)
+        return models
+
+    def _table_sql(self, model_class):
+        # tables in another database are read through attach
+        db_name = router.db_for_write(model_class)
+        if db_name == router.db_for_write(self.model_class):
+            return "`%s`" % model_class._meta.table_name
+        return "%s.`%s`" % (schema_name(db_name), model_class._meta.table_name)
+
+    def _cursor(self):
+        # a cursor of the database to read, with the databases of the joined tables attached
+        db_name = self._read_db()
+        own_db_name = router.db_for_write(self.model_class)
+        for model_class in self._related_models():
+            other_db_name = router.db_for_write(model_class)
+            if other_db_name != own_db_name:
+                attach_database(other_db_name, db_name=db_name)
+        return db_name, get_cursor(db_name=db_name)
+
+    def _tables(self):
+        tables = [self.table_name] + [model_class._meta.table_name for model_class in self._related_models()]
+        return tuple(set(tables))
+
+    def _uncommitted(self):
+        # True when this thread has an open transaction or uncommitted writes to the tables of the query
+        tables = set(self._tables())
+        db_names = set([self._write_db()] + [router.db_for_write(model_class) for model_class in self._related_models()])
+        for db_name in db_names:
+            if in_transaction(db_name) or get_pool(db_name).slot().written_tables & tables:
+                return True
+        return False
+
+    def _fetchall(self, sql):
+        use_cache = self.use_cache
+        if use_cache is None:
+            use_cache = NANO_SETTINGS["query_cache"]
+        if use_cache and self._uncommitted():
+            # the rows may hold writes of this thread that other threads must not see
+            use_cache = False
+        if use_cache:
+            key = (self._write_db(), sql, self.params)
+            rows = query_cache.get(key)
+            if rows is not None:
+                return rows
+            tables = self._tables()
+            generation = query_cache.generation(tables)
+        db_name, cu = self._cursor()
+        execute_sql(cu, sql, self.params, db_name=db_name)
+        rows = cu.fetchall()
+        if use_cache:
+            query_cache.set(key, tables, rows, self.cache_ttl or NANO_SETTINGS["query_cache_ttl"], generation)
+        return rows
+
+    def _clone(self, **kwargs):
+        query = self.__class__.__new__(self.__class__)
+        query.__dict__.update(self.__dict__)
+        query.__dict__.update(kwargs)
+        return query
+
     def filter(self, op="=", **kwargs):
+        """
+        The conditions are joined by and, a name without lookup is compared by op:
+        filter(name="Joe", age__gte=18, area__in=[a, b], leader__isnull=True).
+        The lookups are in LOOKUPS, contains/startswith/endswith use sqlite's like,
+        which ignores the case of ascii letters.
+        """
         where_sql = self.where_sql
+        params = list(self.params)
+        field_map = self.model_class._meta.field_map
         for name, value in kwargs.items():
-            if "`%s`" % name in self.field_names + ["`id`"]:
-                is_string = True
-
-                if isinstance(value, Model):
-                    value = value.id
-                    is_string = False
-
-                if isinstance(value, (int, float)):
-                    is_string = False
-
-                if isinstance(value, bool):
-                    value = 'true' if value else 'false'
-                    is_string = False
-                
-                if isinstance(value, datetime.datetime):
-                    value = value.strftime('%Y-%m-%d %H:%M:%S.%f')
-                
-                if isinstance(value, (str, unicode)):
-                    value = value.replace("'", "''")
-                    try:
-                        value = value.decode("gbk")
-                    except Exception as e:
-                        pass
-                    try:
-                        value = value.decode("utf8")
-                    except Exception as e:
-                        pass
-
-                if is_string:
-                    where_sql += " and `%s` %s '%s'" % (name, op, value)
+            lookup = None
+            if "__" in name and name.rsplit("__", 1)[1] in LOOKUPS:
+                name, lookup = name.rsplit("__", 1)
+            if name.endswith("_id") and name[:-3] in field_map and field_map[name[:-3]].field_level == 1:
+                name = name[:-3]
+            if name != "id" and name not in field_map:
+                assert lookup is None, 'no field named `%s`' % name
+                continue
+            if name == "id":
+                to_db = lambda value: value.id if isinstance(value, Model) else value
+            else:
+                to_db = field_map[name].to_db
+            column = "`%s`.`%s`" % (self.table_name, name)
+
+            if lookup == "in":
+                values = [to_db(v) for v in value]
+                if values:
+                    where_sql += " and %s in (%s)" % (column, ", ".join(["?"] * len(values)))
+                    params.extend(values)
                 else:
-                    where_sql += " and `%s` %s %s" % (name, op, value)
+                    where_sql += " and 0"
+            elif lookup == "isnull":
+                where_sql += " and %s is %snull" % (column, "" if value else "not ")
+            elif lookup in ("contains", "startswith", "endswith"):
+                # like compares text, e.g. age__startswith=1 matches 1 and 12
+                pattern = like_escape(unicode(to_db(value)))
+                if lookup != "startswith":
+                    pattern = "%" + pattern
+                if lookup != "endswith":
+                    pattern += "%"
+                where_sql += " and %s like ? escape '\\'" % column
+                params.append(pattern)
+            else:
+                operator = op if lookup is None else LOOKUPS[lookup]
+                value = to_db(value)
+                if value is None and operator in ("=", "==", "!=", "<>"):
+                    # None is stored as null, which = never matches
+                    where_sql += " and %s is %snull" % (column, "" if operator in ("=", "==") else "not ")
+                else:
+                    where_sql += " and %s %s ?" % (column, operator)
+                    params.append(value)
 
-        query = self.__class__(self.model_class, where_sql, self.order_sql, self.limit_sql)
-        return query
+        return self._clone(where_sql=where_sql, params=tuple(params))
 
     def order(self, field_name):
-        order_sql = "order by " + field_name.replace("-", "")
+        name = field_name.replace("-", "")
+        order_field = None
+        if name == "id" or name in self.model_class._meta.field_map:
+            order_field = (name, field_name[0] == "-")
+            name = "`%s`.`%s`" % (self.table_name, name)
+        order_sql = "order by " + name
         if field_name[0] == "-":
             order_sql += " desc"
-        query = self.__class__(self.model_class, self.where_sql, order_sql, self.limit_sql)
-        return query
+        return self._clone(order_sql=order_sql, order_field=order_field)
 
     def order_by(self, field_name):
         return self.order(field_name)
 
+    def _limited(self, count, offset):
+        if count is None:
+            limit_sql = 'limit -1 offset %d' % offset if offset else ''
+        elif offset:
+            limit_sql = 'limit %d offset %d' % (count, offset)
+        else:
+            limit_sql = 'limit %d' % count
+        return self._clone(limit_sql=limit_sql, limit_count=count, offset_count=offset)
+
     def limit(self, count=1):
-        limit_sql = 'limit %d' % count
-        query = self.__class__(self.model_class, self.where_sql, self.order_sql, limit_sql)
-        return query
+        return self._limited(count, self.offset_count)
+
+    def __getitem__(self, key):
+        # q[100:200] is a new query with limit 100 offset 100, q[5] loads the sixth object
+        if isinstance(key, slice):
+            assert key.step is None, 'slicing with a step is not supported'
+            start = key.start or 0
+            assert start >= 0 and (key.stop is None or key.stop >= 0), 'negative indexes are not supported'
+            count = None if key.stop is None else max(key.stop - start, 0)
+            if self.limit_count is not None:
+                rest = max(self.limit_count - start, 0)
+                count = rest if count is None else min(count, rest)
+            return self._limited(count, self.offset_count + start)
+        assert key >= 0, 'negative indexes are not supported'
+        obs = self[key:key + 1].all()
+        if not obs:
+            raise IndexError('query index out of range')
+        return obs[0]
+
+    def paginate_after(self, cursor=None, page_size=20):
+        """
+        Keyset pagination in the order of order(), by id by default: returns the
+        page_size objects after the cursor, and the cursor of the next page, None
+        after the last page. Deep pages cost the same as the first one, as they
+        start with `where (field, id) > (?, ?)` instead of an offset. Rows whose
+        order field is null come first, or last in descending order, as sqlite
+        sorts null before the other values.
+        """
+        assert not self.limit_sql, 'paginate_after can not be used with limit or slicing'
+        assert self.order_field is not None or not self.order_sql, 'paginate_after needs the order of a field'
+        name, desc = self.order_field or ("id", False)
+        op, direction = ("<", " desc") if desc else (">", "")
+        column = "`%s`.`%s`" % (self.table_name, name)
+        id_column = "`%s`.`id`" % self.table_name
+        if name == "id":
+            order_sql = "order by %s%s" % (id_column, direction)
+        else:
+            order_sql = "order by %s%s, %s%s" % (column, direction, id_column, direction)
+        query = self._clone(order_sql=order_sql)
+
+        if cursor is not None:
+            key = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")).decode("utf8"))
+            assert key[0] == name, 'the cursor is of another order'
+            if name == "id":
+                where_sql = " and %s %s ?" % (id_column, op)
+                params = (key[2],)
+            elif key[1] is None:
+                # the page ended on a null, the other nulls come next, then the values if ascending
+                where_sql = " and (%s is null and %s %s ?%s)" % (column, id_column, op, "" if desc else " or %s is not null" % column)
+                params = (key[2],)
+            else:
+                if sqlite3.sqlite_version_info >= (3, 15, 0):
+                    where_sql = "(%s, %s) %s (?, ?)" % (column, id_column, op)
+                    params = (key[1], key[2])
+                else:
+                    # no row values before sqlite 3.15
+                    where_sql = "%s %s ? or (%s = ? and %s %s ?)" % (column, op, column, id_column, op)
+                    params = (key[1], key[1], key[2])
+                # in descending order the nulls come after the values
+                where_sql = " and (%s%s)" % (where_sql, " or %s is null" % column if desc else "")
+            query = query._clone(where_sql=query.where_sql + where_sql, params=query.params + params)
+
+        obs = query[:page_size + 1].all()
+        if len(obs) <= page_size:
+            return obs, None
+        obs = obs[:page_size]
+        last = obs[-1]
+        value = None
+        if name != "id":
+            field = self.model_class._meta.field_map[name]
+            value = field.get_id(last) if field.field_level == 1 else field.to_db(getattr(last, name))
+        key = json.dumps([name, value, last.id])
+        return obs, base64.urlsafe_b64encode(key.encode("utf8")).decode("ascii")
 
     def _r2ob(self, r):
-        # 数据库查得的一行记录转为 Model 对象
-        rid = r[0]
-        ob = self.model_class(rid=rid)
-        for i in range(1, len(r)):
-            name = self.field_names[i - 1]
-            field = getattr(self.model_class, name.replace("`", ""))
-
-            if field.field_level == 0:
-                value = r[i]
-                value = None if value == 'None' else value
-
-                if field.field_type == "boolean":
-                    if value in ['True', 'False']:
-                        # 兼容老版本
-                        value = eval(value)
-                    else:
-                        value = bool(value == 1)
-
-                if field.field_type == "datetime" and value:
-                    value = datetime.datetime.strptime(value, '%Y-%m-%d %H:%M:%S.%f') if value else None
-                
-                if field.field_type == "date" and value:
-                    value = datetime.datetime.strptime(value, '%Y-%m-%d').date() if value else None
+        # 数据库查得的一行记录转为 Model 对象, 不经过 Model.__init__
+        if self.loaded_indexes is not None:
+            return self._partial_r2ob(r)
+        if self.related_paths:
+            if self._related_join is None:
+                self._compile_related()
+            return self._joined_r2ob(r, self._related_join)
+        meta = self.model_class._meta
+        ob = self.model_class.__new__(self.model_class)
+        ob.id = r[0]
+        for name, convert, value in zip(meta.field_names, meta.row_converters, r[1:]):
+            setattr(ob, name, value if convert is None else convert(value))
+        ob._saved_values = r[1:]
+        return ob
 
-            elif field.field_level == 1:
-                if field.field_type == "selfforeignkey":
-                    field.model_class = self.model_class
-                fid = r[i]
-                if fid:
-                    value = field.model_class.get(id=fid)
-                else:
-                    value = None
+    def _partial_r2ob(self, r):
+        # 用 only/defer 查得的一行记录转为 Model 对象, 其余字段访问时再加载
+        meta = self.model_class._meta
+        ob = self.model_class.__new__(self.model_class)
+        ob.id = r[0]
+        saved = [DEFERRED] * len(meta.fields)
+        for i, value in zip(self.loaded_indexes, r[1:]):
+            setattr(ob, meta.field_names[i], meta.converters[i](value))
+            saved[i] = value
+        ob._saved_values = saved
+        return ob
 
-            setattr(ob, name.replace("`", ""), value)
+    def _joined_r2ob(self, r, join):
+        # 用 select_related 查得的一行记录转为 Model 对象, 关联对象取自同一行
+        offset = join.offset
+        if r[offset] is None:
+            return None
+        meta = join.model_class._meta
+        ob = join.model_class.__new__(join.model_class)
+        ob.id = r[offset]
+        values = r[offset + 1:offset + 1 + len(meta.fields)]
+        for name, convert, value in zip(meta.field_names, meta.row_converters, values):
+            setattr(ob, name, value if convert is None else convert(value))
+        for i, child in join.children.items():
+            meta.fields[i].cache(ob, self._joined_r2ob(r, child))
+        ob._saved_values = values
         return ob
 
-    def all(self):
-        cu = get_cursor()
-        sql = self.query_sql
-        execute_sql(cu, sql)
-        rows = cu.fetchall()
-        obs = []
-        for r in rows:
-            ob = self._r2ob(r)
-            obs.append(ob)
+    def _load(self, rows):
+        obs = [self._r2ob(r) for r in rows]
+        if self.prefetch_paths:
+            prefetch_related_objects(obs, *self.prefetch_paths)
         return obs
 
+    def iterator(self, chunk_size=100):
+        # yield the objects while fetching chunk_size rows at a time
+        db_name, cu = self._cursor()
+        execute_sql(cu, self.query_sql, self.params, db_name=db_name)
+        while True:
+            rows = cu.fetchmany(chunk_size)
+            if not rows:
+                break
+            for ob in self._load(rows):
+                yield ob
+
+    def __iter__(self):
+        return self.iterator()
+
+    def __aiter__(self):
+        return AsyncQueryIterator(self)
+
+    def aiterator(self, chunk_size=100):
+        return AsyncQueryIterator(self, chunk_size)
+
+    def aall(self):
+        return get_async_executor().run(self.all)
+
+    def afirst(self):
+        return get_async_executor().run(self.first)
+
+    def acount(self):
+        return get_async_executor().run(self.count)
+
+    def aexists(self):
+        return get_async_executor().run(self.exists)
+
+    def aupdate(self, **kwargs):
+        return get_async_executor().write(self.update, **kwargs)
+
+    def adelete(self):
+        return get_async_executor().write(self.delete)
+
+    def all(self):
+        rows = self._fetchall(self.query_sql)
+        return self._load(rows)
+
     def first(self):
-        cu = get_cursor()
-        sql = self.limit(1).query_sql
-        execute_sql(cu, sql)
-        rows = cu.fetchall()
+        rows = self._fetchall(self[:1].query_sql)
         if rows:
-            r = rows[0]
-            ob = self._r2ob(r)
-            return ob
+            return self._load(rows[:1])[0]
         else:
             return None
 
     def last(self):
-        cu = get_cursor()
-        sql = self.query_sql
-        execute_sql(cu, sql)
-        rows = cu.fetchall()
-        if rows:
-            r = rows[-1]
-            ob = self._r2ob(r)
+        if self.limit_sql:
+            ob = None
+            for ob in self.iterator():
+                pass
             return ob
+
+        if not self.order_sql:
+            order_sql = "order by `%s`.`id` desc" % self.table_name
+        elif self.order_sql.endswith(" desc"):
+            order_sql = self.order_sql[:-len(" desc")]
         else:
-            return None
+            order_sql = self.order_sql + " desc"
+        return self._clone(order_sql=order_sql).first()
+
+    def only(self, *fields):
+        # load just these fields, the others are loaded when they are accessed
+        meta = self.model_class._meta
+        assert not meta.compact, 'compact models do not support only/defer'
+        for name in fields:
+            assert name in meta.field_map, 'no field named `%s`' % name
+        indexes = [i for i, name in enumerate(meta.field_names) if name in fields]
+        return self._clone(loaded_indexes=indexes)
+
+    def defer(self, *fields):
+        # load all the fields but these, they are loaded when they are accessed
+        meta = self.model_class._meta
+        assert not meta.compact, 'compact models do not support only/defer'
+        for name in fields:
+            assert name in meta.field_map, 'no field named `%s`' % name
+        indexes = self.loaded_indexes
+        if indexes is None:
+            indexes = range(len(meta.fields))
+        return self._clone(loaded_indexes=[i for i in indexes if meta.field_names[i] not in fields])
+
+    def rows(self):
+        """
+        The matched rows as read-only namedtuples of id and all the fields,
+        foreign keys give the id. They are much smaller than model objects.
+        """
+        meta = self.model_class._meta
+        make = meta.row_class._make
+        converters = meta.row_converters
+        sql = "select %s from `%s` where %s %s %s;" % (meta.select_sql, self.table_name, self.where_sql, self.order_sql, self.limit_sql)
+        return [make([r[0]] + [value if convert is None else convert(value) for convert, value in zip(converters, r[1:])])
+                for r in self._fetchall(sql)]
+
+    def _values_rows(self, fields):
+        meta = self.model_class._meta
+        fields = fields or ["id"] + meta.field_names
+        converters = []
+        for name in fields:
+            if name == "id":
+                converters.append(None)
+            else:
+                assert name in meta.field_map, 'no field named `%s`' % name
+                converters.append(meta.field_map[name].to_python)
+        columns_sql = ", ".join(["`%s`.`%s`" % (self.table_name, name) for name in fields])
+        sql = "select %s from `%s` where %s %s %s;" % (columns_sql, self.table_name, self.where_sql, self.order_sql, self.limit_sql)
+        rows = self._fetchall(sql)
+        if any(converters):
+            rows = [tuple([value if convert is None else convert(value) for convert, value in zip(converters, r)]) for r in rows]
+        return fields, rows
+
+    def values(self, *fields):
+        """
+        Select only these fields (default all), one dict per row without building objects,
+        foreign keys give the id, e.g. values('name', 'age') -> [{'name': 'Joe', 'age': 46}]
+        """
+        fields, rows = self._values_rows(fields)
+        return [dict(zip(fields, r)) for r in rows]
+
+    def values_list(self, *fields, **kwargs):
+        """
+        Like values() with one tuple per row, or just the value with flat=True and one field
+        """
+        flat = kwargs.get("flat", False)
+        assert not flat or len(fields) == 1, 'flat=True only works with one field'
+        fields, rows = self._values_rows(fields)
+        if flat:
+            return [r[0] for r in rows]
+        return list(rows)
+
+    def explain(self):
+        # the steps of sqlite's query plan, e.g. to check that a filter uses an index
+        db_name, cu = self._cursor()
+        execute_sql(cu, "explain query plan " + self.query_sql, self.params, db_name=db_name)
+        return [r[-1] for r in cu.fetchall()]
+
+    def count(self):
+        if self.limit_sql:
+            sql = "select count(*) from (select `id` from `%s` where %s %s %s);" % (self.table_name, self.where_sql, self.order_sql, self.limit_sql)
+        else:
+            sql = "select count(*) from `%s` where %s;" % (self.table_name, self.where_sql)
+        return self._fetchall(sql)[0][0]
+
+    def exists(self):
+        if self.limit_sql:
+            sql = "select 1 from (select `id` from `%s` where %s %s %s) limit 1;" % (self.table_name, self.where_sql, self.order_sql, self.limit_sql)
+        else:
+            sql = "select 1 from `%s` where %s limit 1;" % (self.table_name, self.where_sql)
+        return len(self._fetchall(sql)) > 0
+
+    def aggregate(self, **aggregates):
+        """
+        Compute aggregates over the matched rows in sql, e.g.
+        aggregate(total=Sum('score'), oldest=Max('age')) -> {'total': 19.0, 'oldest': 46}
+        """
+        names = list(aggregates)
+        select_sql = ", ".join([aggregates[name].sql(self.model_class) for name in names])
+        if self.limit_sql:
+            # only the rows in the limit, the subquery keeps the table name for the columns
+            sql = "select %s from (select * from `%s` where %s %s %s) `%s`;" % (
+                select_sql, self.table_name, self.where_sql, self.order_sql, self.limit_sql, self.table_name)
+        else:
+            sql = "select %s from `%s` where %s;" % (select_sql, self.table_name, self.where_sql)
+        r = self._fetchall(sql)[0]
+        return dict((name, aggregates[name].to_python(self.model_class, value)) for name, value in zip(names, r))
+
+    def group_by(self, *fields, **aggregates):
+        """
+        Compute aggregates for each group of rows in sql, one dict per group, e.g.
+        group_by('sex', count=Count()) -> [{'sex': False, 'count': 1}, {'sex': True, 'count': 2}]
+        """
+        meta = self.model_class._meta
+        assert fields, 'group_by needs at least one field, see aggregate() for all the rows'
+        for name in fields:
+            assert name in meta.field_map, 'no field named `%s`' % name
+        names = list(aggregates)
+        group_sql = ", ".join(["`%s`.`%s`" % (self.table_name, name) for name in fields])
+        select_sql = ", ".join([group_sql] + [aggregates[name].sql(self.model_class) for name in names])
+        order_sql = self.order_sql or "order by " + group_sql
+        sql = "select %s from `%s` where %s group by %s %s %s;" % (select_sql, self.table_name, self.where_sql, group_sql, order_sql, self.limit_sql)
+        converters = [meta.field_map[name].to_python for name in fields]
+        groups = []
+        for r in self._fetchall(sql):
+            group = dict((name, convert(value)) for name, convert, value in zip(fields, converters, r))
+            for name, value in zip(names, r[len(fields):]):
+                group[name] = aggregates[name].to_python(self.model_class, value)
+            groups.append(group)
+        return groups
+
+    def _write_where_sql(self):
+        # sqlite's update and delete take no limit, so a limited query picks its ids in a subquery
+        if self.limit_sql:
+            return "`id` in (select `id` from `%s` where %s %s %s)" % (self.table_name, self.where_sql, self.order_sql, self.limit_sql)
+        return self.where_sql
+
+    def update(self, **kwargs):
+        # update the matched rows with one statement, auto_now fields are bumped too
+        meta = self.model_class._meta
+        names = []
+        values = []
+        for name, value in kwargs.items():
+            assert name in meta.field_map, 'no field named `%s`' % name
+            names.append(name)
+            values.append(meta.field_map[name].to_db(value))
+        for i in meta.auto_now_indexes:
+            name = meta.field_names[i]
+            if name not in kwargs:
+                names.append(name)
+                values.append(meta.fields[i].to_db(meta.fields[i].now()))
+        if not names:
+            return 0
+
+        db_name = self._write_db()
+        cu = get_cursor(db_name=db_name)
+        set_sql = ", ".join(["`%s`=?" % name for name in names])
+        sql = "update `%s` set %s where %s" % (self.table_name, set_sql, self._write_where_sql())
+        execute_sql(cu, sql, values + list(self.params), db_name=db_name)
+        table_written(self.table_name, db_name)
+        db_commit(db_name=db_name)
+        session = Session.current()
+        if session is not None:
+            session.discard(self.model_class)
+        return cu.rowcount
 
     def delete(self):
-        cu = get_cursor()
-        sql = "delete from `%s` where %s" % (self.table_name, self.where_sql)
-        execute_sql(cu, sql)
-        db_commit()
+        db_name = self._write_db()
+        cu = get_cursor(db_name=db_name)
+        sql = "delete from `%s` where %s" % (self.table_name, self._write_where_sql())
+        execute_sql(cu, sql, self.params, db_name=db_name)
+        table_written(self.table_name, db_name)
+        db_commit(db_name=db_name)
+        session = Session.current()
+        if session is not None:
+            session.discard(self.model_class)
 
 # THE END
@@ -0,0 +1,365 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# ==================================
+# benchmarks of Nanorm
+# ==================================
+
+"""
+Run the benchmarks against a temp file and a :memory: database, and write the results as json:
+
+    python nanorm_benchmark.py --rows 10000 --output base.json
+    python nanorm_benchmark.py --rows 10000 --only get,filter_all --db memory
+
+Every metric is a time or a size, so lower is better. Compare two runs, the
+exit code is 1 when a metric got worse by more than the threshold:
+
+    python nanorm_benchmark.py compare base.json new.json --threshold 0.1
+"""
+
+import os
+import sys
+import json
+import time
+import datetime
+import random
+import sqlite3
+import argparse
+import platform
+import tempfile
+import threading
+
+import nanorm
+from nanorm import *
+
+timer = getattr(time, "perf_counter", time.time)
+
+
+class BenchRow(Model):
+    name = CharField(index=True)
+    value = IntegerField(index=True)
+    score = FloatField()
+    created = DateTimeField()
+
+
+class BenchParent(Model):
+    name = CharField()
+
+
+class BenchChild(Model):
+    parent = ForeignKey(BenchParent)
+    value = IntegerField()
+    label = CharField()
+
+
+def make_model(columns):
+    attrs = {}
+    for i in range(columns):
+        attrs["f%02d" % i] = IntegerField()
+    return type("Wide%d" % columns, (Model,), attrs)
+
+
+def timed(func, repeat=1):
+    # the best of repeat runs, in seconds
+    best = None
+    for _ in range(repeat):
+        start = timer()
+        func()
+        seconds = timer() - start
+        best = seconds if best is None else min(best, seconds)
+    return best
+
+
+def new_row(i):
+    return BenchRow(name="row%d" % i, value=i, score=i / 3.0, created=datetime.datetime(2020, 1, 1, 12, 0, 0, i % 1000000))
+
+
+def fill_rows(rows):
+    # make BenchRow hold exactly rows rows
+    if BenchRow.query().count() != rows:
+        BenchRow.query().delete()
+        BenchRow.bulk_insert(new_row(i) for i in range(rows))
+
+
+def bench_construct(rows, repeat):
+    # Model() without touching the database
+    n = min(rows, 100000)
+    seconds = timed(lambda: [new_row(i) for i in range(n)], repeat)
+    return {"us_per_object": seconds / n * 1e6}
+
+
+def bench_save(rows, repeat):
+    # single save() calls, each one commits
+    n = min(rows, 1000)
+    BenchRow.query().delete()
+    obs = [new_row(i) for i in range(n)]
+    insert_seconds = timed(lambda: [ob.save() for ob in obs], 1)
+
+    def update():
+        for ob in obs:
+            ob.value += 1
+            ob.save()
+
+    update_seconds = timed(update, repeat)
+    return {"us_per_insert": insert_seconds / n * 1e6, "us_per_update": update_seconds / n * 1e6}
+
+
+def bench_bulk(rows, repeat):
+    def load():
+        BenchRow.query().delete()
+        BenchRow.bulk_insert(new_row(i) for i in range(rows))
+
+    seconds = timed(load, repeat)
+    return {"seconds": seconds, "us_per_row": seconds / rows * 1e6}
+
+
+def bench_get(rows, repeat):
+    fill_rows(rows)
+    n = min(rows, 2000)
+    ids = [ob.id for ob in BenchRow.query().only("value").all()]
+    ids = random.Random(0).sample(ids, n)
+    seconds = timed(lambda: [BenchRow.get(id=rid) for rid in ids], repeat)
+    return {"us_per_get": seconds / n * 1e6}
+
+
+def bench_filter_all(rows, repeat):
+    fill_rows(rows)
+    all_seconds = timed(lambda: BenchRow.query().all(), repeat)
+    half = BenchRow.query().filter(op=">=", value=rows // 2)
+    filter_seconds = timed(half.all, repeat)
+    return {
+        "all_seconds": all_seconds,
+        "all_us_per_row": all_seconds / rows * 1e6,
+        "filter_half_seconds": filter_seconds,
+        "rows_us_per_row": timed(lambda: BenchRow.query().rows(), repeat) / rows * 1e6,
+    }
+
+
+def bench_fk(rows, repeat):
+    # children with a foreign key, loaded lazily, by select_related and by prefetch_related
+    if BenchChild.query().count() != rows:
+        BenchChild.query().delete()
+        BenchParent.query().delete()
+        parents = BenchParent.bulk_insert(BenchParent(name="parent%d" % i) for i in range(max(rows // 10, 1)))
+        BenchChild.bulk_insert(BenchChild(parent=parents[i % len(parents)], value=i, label="child%d" % i) for i in range(rows))
+
+    n = min(rows, 2000)
+    lazy = timed(lambda: [ob.parent.name for ob in BenchChild.query().limit(n).all()], repeat)
+    joined = timed(lambda: [ob.parent.name for ob in BenchChild.query().select_related("parent").all()], repeat)
+    prefetched = timed(lambda: [ob.parent.name for ob in BenchChild.query().prefetch_related("parent").all()], repeat)
+    return {
+        "lazy_us_per_row": lazy / n * 1e6,
+        "select_related_us_per_row": joined / rows * 1e6,
+        "prefetch_related_us_per_row": prefetched / rows * 1e6,
+    }
+
+
+def bench_materialize(rows, repeat, column_counts=(1, 4, 16, 32)):
+    # time spent turning fetched rows into Model objects by _r2ob, by column count
+    results = {}
+    n = min(rows, 10000)
+    for columns in column_counts:
+        model = make_model(columns)
+        model.query().delete()
+        model.bulk_insert(model(**dict(("f%02d" % c, i) for c in range(columns))) for i in range(n))
+
+        query = model.query()
+        cu = get_cursor()
+        execute_sql(cu, query.query_sql)
+        fetched = cu.fetchall()
+
+        seconds = timed(lambda: [query._r2ob(r) for r in fetched], repeat)
+        results["us_per_row_%dcols" % columns] = seconds / n * 1e6
+    return results
+
+
+def bench_memory(rows, repeat, columns=12):
+    # bytes per loaded row: model objects, compact model objects and Query.rows() tuples
+    import tracemalloc
+
+    results = {}
+    n = min(rows, 100000)
+    for compact in (False, True):
+        attrs = {"compact": compact}
+        for i in range(columns):
+            attrs["f%02d" % i] = IntegerField()
+        model = type("Mem%s%d" % ("Compact" if compact else "", columns), (Model,), attrs)
+        model.query().delete()
+        model.bulk_insert(model(**dict(("f%02d" % c, i) for c in range(columns))) for i in range(n))
+
+        query = model.query()
+        kinds = [("compact_objects" if compact else "objects", query.all)]
+        if not compact:
+            kinds.append(("rows", query.rows))
+        for kind, load in kinds:
+            tracemalloc.start()
+            loaded = load()
+            size = tracemalloc.get_traced_memory()[0]
+            tracemalloc.stop()
+            del loaded
+            results["bytes_per_row_%s" % kind] = float(size) / n
+    return results
+
+
+def bench_contention(rows, repeat, readers=4, writers=2):
+    # threads reading and writing at the same time, through the mutex and sqlite's write lock
+    fill_rows(min(rows, 10000))
+    ids = [ob.id for ob in BenchRow.query().only("value").limit(1000).all()]
+    n = min(rows, 500)
+    errors = []
+
+    def read(seed):
+        chooser = random.Random(seed)
+        try:
+            for _ in range(n):
+                BenchRow.get(id=chooser.choice(ids))
+        except Exception as e:
+            errors.append(e)
+
+    def write(seed):
+        try:
+            for i in range(n):
+                new_row(seed * n + i).save()
+        except Exception as e:
+            errors.append(e)
+
+    def run():
+        threads = [threading.Thread(target=read, args=(i,)) for i in range(readers)]
+        threads += [threading.Thread(target=write, args=(i,)) for i in range(writers)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+    get_mutex_stats(reset=True)
+    seconds = timed(run, repeat)
+    stats = get_mutex_stats(reset=True)
+    assert not errors, errors[0]
+    # the mutex only waits on a shared :memory: connection, the writers of a file wait for sqlite's write lock
+    write_lock = stats.pop("write_lock", {"calls": 0, "wait_seconds": 0.0})
+    calls = sum(counters["calls"] for counters in stats.values()) or 1
+    return {
+        "seconds": seconds,
+        "us_per_op": seconds / (n * (readers + writers)) * 1e6,
+        "mutex_wait_us_per_call": sum(counters["wait_seconds"] for counters in stats.values()) / calls * 1e6,
+        "write_lock_wait_us_per_transaction": write_lock["wait_seconds"] / (write_lock["calls"] or 1) * 1e6,
+    }
+
+
+BENCHMARKS = [
+    ("construct", bench_construct),
+    ("save", bench_save),
+    ("bulk", bench_bulk),
+    ("get", bench_get),
+    ("filter_all", bench_filter_all),
+    ("fk", bench_fk),
+    ("materialize", bench_materialize),
+    ("memory", bench_memory),
+    ("contention", bench_contention),
+]
+
+
+def run(rows, repeat, dbs, only=None):
+    results = {}
+    for db in dbs:
+        if db == "file":
+            fd, db_name = tempfile.mkstemp(suffix=".db")
+            os.close(fd)
+        else:
+            db_name = ":memory:"
+        try:
+            set_db_name(db_name)
+            results[db] = {}
+            for name, bench in BENCHMARKS:
+                if only and name not in only:
+                    continue
+                if name == "memory" and sys.version_info < (3, 4):
+                    continue
+                results[db][name] = bench(rows, repeat)
+                sys.stderr.write("%s %s: %s\n" % (db, name, json.dumps(results[db][name], sort_keys=True)))
+        finally:
+            close_connections()
+            if db == "file":
+                for suffix in ("", "-wal", "-shm"):
+                    if os.path.exists(db_name + suffix):
+                        os.remove(db_name + suffix)
+    return {
+        "meta": {
+            "nanorm": nanorm.__VERSION__,
+            "python": platform.python_version(),
+            "sqlite": sqlite3.sqlite_version,
+            "platform": platform.platform(),
+            "rows": rows,
+            "repeat": repeat,
+            "time": time.strftime("%Y-%m-%d %H:%M:%S"),
+        },
+        "results": results,
+    }
+
+
+def flatten(results):
+    metrics = {}
+    for db, benches in results["results"].items():
+        for bench, values in benches.items():
+            for metric, value in values.items():
+                metrics["%s.%s.%s" % (db, bench, metric)] = value
+    return metrics
+
+
+def compare(base, new, threshold=0.1):
+    # print the change of every metric, return the names of the ones worse by more than threshold
+    old_metrics = flatten(base)
+    new_metrics = flatten(new)
+    regressions = []
+    for name in sorted(set(old_metrics) & set(new_metrics)):
+        old, value = old_metrics[name], new_metrics[name]
+        change = (value - old) / old if old else 0.0
+        mark = ""
+        if change > threshold:
+            mark = "REGRESSION"
+            regressions.append(name)
+        elif change < -threshold:
+            mark = "improved"
+        print("%-55s %12.3f %12.3f %+7.1f%% %s" % (name, old, value, change * 100, mark))
+    for name in sorted(set(old_metrics) ^ set(new_metrics)):
+        print("%-55s only in %s" % (name, "base" if name in old_metrics else "new"))
+    return regressions
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if argv and argv[0] == "compare":
+        parser = argparse.ArgumentParser(prog="nanorm_benchmark.py compare")
+        parser.add_argument("base")
+        parser.add_argument("new")
+        parser.add_argument("--threshold", type=float, default=0.1, help="relative change counted as a regression")
+        args = parser.parse_args(argv[1:])
+        with open(args.base) as f:
+            base = json.load(f)
+        with open(args.new) as f:
+            new = json.load(f)
+        regressions = compare(base, new, args.threshold)
+        print("%d regressions" % len(regressions))
+        return 1 if regressions else 0
+
+    parser = argparse.ArgumentParser(prog="nanorm_benchmark.py")
+    parser.add_argument("--rows", type=int, default=10000, help="rows of the tables, e.g. 10000 to 1000000")
+    parser.add_argument("--repeat", type=int, default=3, help="runs of each timing, the best one counts")
+    parser.add_argument("--db", default="file,memory", help="file, memory or both")
+    parser.add_argument("--only", default="", help="comma separated benchmarks: %s" % ",".join(name for name, _ in BENCHMARKS))
+    parser.add_argument("--output", help="json file, stdout by default")
+    args = parser.parse_args(argv)
+
+    random.seed(0)
+    results = run(args.rows, args.repeat, args.db.split(","), [name for name in args.only.split(",") if name])
+    text = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
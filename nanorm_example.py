@@ -7,6 +7,9 @@
 
 from nanorm import *
 import datetime
+import sqlite3
+import sys
+import threading
 
 
 class Area(Model):
@@ -18,7 +21,7 @@ def tomorrow():
 
 
 class User(Model):
-    name = CharField(128)           # CharField default="" max_length=255
+    name = CharField(128, index=True)   # CharField default="" max_length=255, index=True adds an index
     age = IntegerField()            # IntegerField default=0
     score = FloatField(default=6.8) # FloatField default=0.0
     sex = BooleanField()            # BooleanField default=True
@@ -30,6 +33,8 @@ class User(Model):
     create_time = DateTimeField(auto_now_add=True)
     update_time = DateTimeField(auto_now=True)
 
+    index_together = [("sex", "age")]    # indexes of several fields, also unique_together
+
     def __str__(self):
         return "%s_%s_%s_%s_%s" % (self.__class__.__name__, self.id, self.name, self.age, self.sex)
 
@@ -197,7 +202,374 @@ assert sandy.finish_time == now
 
 # ==============================================
 
+areas = [Area(name="area_%d" % i) for i in range(10)]
+Area.bulk_insert(areas, batch_size=4)     # insert many objects with executemany, one commit per batch
+
+assert Area.get(name="area_7").id == areas[7].id
+
+for area in areas[:5]:
+    area.name += "_renamed"
+areas.append(Area(name="area_10"))
+Area.bulk_save(areas)                       # update the saved objects and insert the new ones
+
+assert Area.get(id=areas[3].id).name == "area_3_renamed"
+assert len(Area.gets()) == 15
+
+# ==============================================
+
+joe = User.get(name="Joe")
+assert joe.changed_fields == []       # nothing changed since loaded, so save() runs no sql
+joe.save()
+
+joe.age = 46
+assert joe.changed_fields == ["age"]  # only the changed fields (and auto_now fields) are written
+joe.save()
+
+assert User.get(id=joe.id).age == 46
+
+# ==============================================
+
+n = User.query().filter(sex=True).update(score=9.5)    # update all matched rows with one sql
+
+assert n == 2
+assert User.get(name="Joe").score == 9.5
+
+n = User.query().filter(sex=True).order("age").limit(1).update(score=9.5)   # or only the rows in the limit
+
+assert n == 1
+
+# ==============================================
+
+names = [user.name for user in User.query().order("name")]     # iterate a query to stream the objects
+
+assert names == ["Joe", "Motive", "Sandy"]
+
+names = [user.name for user in User.query().iterator(chunk_size=2)]   # fetch 2 rows at a time
+
+assert len(names) == 3
+assert User.query().order("-age").last().name == "Sandy"
+
+# ==============================================
+
+sandy = User.query().filter(name="Sandy").select_related("area", "leader__area").first()    # load foreign keys with left join
+
+assert sandy.area.name == "mainland"
+assert sandy.leader.area.name == "taiwan"
+
+users = User.query().select_related(depth=2).order("name").all()   # follow all foreign keys up to 2 levels
+
+assert [user.area.name for user in users] == ["taiwan", "taiwan", "mainland"]
+assert users[2].leader.name == "Joe"
+
+# ==============================================
+
+users = User.query().prefetch_related("area", "leader").order("name").all()  # load foreign keys with one `in` query per relation
+
+assert [user.area.name for user in users] == ["taiwan", "taiwan", "mainland"]
+
+taiwan = Area.query().filter(name="taiwan").prefetch_related("user_set").first()  # reverse relation, named <model>_set by default
+
+assert sorted(user.name for user in taiwan.user_set) == ["Joe", "Motive"]
+assert len(mainland.user_set) == 1      # not prefetched, queried when accessed
+
+
+class Trip(Model):
+    start = ForeignKey(Area, related_name="trips_from")     # area.trips_from
+    end = ForeignKey(Area)                                  # area.trip_set, another key to Area would need related_name for one
+
+assert not Trip.query().filter(start=taiwan).exists() and len(taiwan.trips_from) == 0
+
+# ==============================================
+
+sandy = User.get(name="Sandy")      # foreign keys are loaded when they are first accessed
+
+assert sandy.leader_id == joe.id    # use <field>_id to get the id without loading the object
+assert sandy.leader.name == "Joe"
+assert User.get(area_id=mainland.id) == sandy
+
+# ==============================================
+
+with Session(max_size=1000) as session:     # an identity map for get(id=...) and foreign keys in the block
+    users = User.query().all()
+    assert users[0].area is users[1].area   # the same area is loaded once
+    assert Area.get(id=taiwan.id) is users[0].area
+    assert session.hits == 2
+
+    Area.query().filter(name="uk").delete()     # writes drop the cached objects of the model
+    assert Area.get(id=taiwan.id) is not users[0].area
+
+# ==============================================
+
+stats = get_mutex_stats()       # calls, contention, wait and hold time of each locked function
+
+assert stats["execute_sql"]["calls"] > 0
+assert stats["write_lock"]["calls"] > 0     # waits of the writers of other connections for sqlite's write lock
+
+# ==============================================
+
+with atomic():                          # save all the objects in one transaction
+    Area(name="france").save()
+    try:
+        with atomic():                  # nested blocks are savepoints
+            Area(name="spain").save()
+            raise ValueError()
+    except ValueError:
+        pass                            # the inner block is rolled back
+
+assert Area.get(name="france")
+assert Area.get(name="spain") is None
+
+
+@atomic                                 # or use atomic as a decorator
+def add_areas(*names):
+    for name in names:
+        Area(name=name).save()
+    raise ValueError()
+
+try:
+    add_areas("italy", "greece")
+except ValueError:
+    pass
+
+assert Area.get(name="italy") is None
+
+
+class Importer(object):
+    @atomic(db_name="nanorm.db")                # methods too, on a given database
+    def add(self, name):
+        Area(name=name).save()
+        raise ValueError()
+
+try:
+    Importer().add("italy")
+except ValueError:
+    pass
+
+assert Area.get(name="italy") is None
+
+
+class Tag(Model):
+    name = CharField(unique=True)
+
+
+Tag.query().delete()
+Tag(name="news").save()
+try:
+    Tag(name="news").save()             # a failed write is rolled back at once
+except sqlite3.IntegrityError:
+    pass
+
+assert not in_transaction()             # so it does not keep the write lock from the other threads
+
+tagged = []
+t = threading.Thread(target=lambda: tagged.append(Tag(name="sport").save()))
+t.start()
+t.join()
+assert tagged and Tag.query().count() == 2
+
+# ==============================================
+
+assert User.query().count() == 3                    # count, exists and aggregates run in sql
+assert User.query().filter(sex=False).exists()
+assert not User.query().filter(name="Nobody").exists()
+
+stats = User.query().aggregate(total=Sum("score"), oldest=Max("age"), n=Count())
+
+assert stats == {"total": 9.5 * 2 + 6.8, "oldest": 46, "n": 3}
+
+groups = User.query().group_by("sex", n=Count(), age=Avg("age"))     # one dict of aggregates per group
+
+assert groups == [{"sex": False, "n": 1, "age": 32}, {"sex": True, "n": 2, "age": 43}]
+
+# ==============================================
+
+rows = User.query().order("age").values("name", "age")      # select some fields as dicts, no objects are built
+
+assert rows[0] == {"name": "Sandy", "age": 32}
+assert User.query().order("age").values_list("name", "sex")[0] == ("Sandy", False)
+assert User.query().order("age").values_list("name", flat=True) == ["Sandy", "Motive", "Joe"]
+
+sandy = User.query().filter(name="Sandy").only("name", "age").first()    # load only some fields of the objects
+
+assert sandy.age == 32
+assert sandy.score == 6.8       # the other fields are loaded when accessed
+
+sandy = User.query().filter(name="Sandy").defer("finish_time").first()   # or leave out some fields
+sandy.age = 33
+sandy.save()                    # only the changed fields are written
+
+assert User.get(name="Sandy").finish_time == now
+
+# ==============================================
+
+plan = User.query().filter(name="Joe").explain()    # sqlite's query plan, to check that the filter uses an index
+
+assert "idx_user_name" in plan[0]
+
+# ==============================================
+
+q = User.query().filter(sex=True).cache(ttl=30)     # cache the results for 30 seconds, or set NANO_SETTINGS["query_cache"]
+
+assert len(q.all()) == 2
+assert len(q.all()) == 2                            # no sql, the rows come from the cache
+assert query_cache.stats()["hits"] == 1
+
+User(name="Tom").save()                             # writes to the table drop its cached results
+assert len(q.all()) == 3
+
+written = threading.Event()
+read = threading.Event()
+seen = []
+
+def write_and_roll_back():
+    try:
+        with atomic():
+            User(name="Ghost").save()
+            assert len(q.all()) == 4                # its own uncommitted row, not cached for the others
+            written.set()
+            read.wait(10)
+            raise ValueError("roll back")
+    except ValueError:
+        pass
+
+def read_meanwhile():
+    written.wait(10)
+    seen.append(len(q.all()))
+    read.set()
+
+threads = [threading.Thread(target=write_and_roll_back), threading.Thread(target=read_meanwhile)]
+for t in threads:
+    t.start()
+for t in threads:
+    t.join()
+assert seen == [3] and len(q.all()) == 3
+
+paused = threading.Event()
+resume = threading.Event()
+
+class PauseReads(SqlHook):
+    def after(self, event):                         # hold the reader after its select, while a write is committed
+        if threading.current_thread().name == "reader" and event.sql.startswith("select"):
+            paused.set()
+            resume.wait(10)
+
+query_cache.clear()
+pause = add_sql_hook(PauseReads())
+reader = threading.Thread(target=q.all, name="reader")
+reader.start()
+paused.wait(10)
+User(name="Jerry").save()
+resume.set()
+reader.join()
+remove_sql_hook(pause)
+
+assert len(q.all()) == 4                            # the rows read before the write were not cached
+User.query().filter(name="Jerry").delete()
+
+# ==============================================
+
+class Visit(Model):
+    compact = True          # instances use __slots__ instead of __dict__, to save memory
+    user = ForeignKey(User)
+    count = IntegerField()
+
+Visit(user=joe, count=3).save()
+visit = Visit.get(user=joe)
+
+assert visit.user.name == "Joe"
+assert not hasattr(visit, "__dict__")
+
+rows = User.query().order("age").rows()     # read-only namedtuples, foreign keys give the id
+
+assert rows[0].name == "Tom" and rows[1].area == mainland.id
+
+# ==============================================
+
+cu = get_cursor()
+cu.execute("update user set finish_time = 'None', sex = 'True' where id = ?", (joe.id,))    # as written by old versions
+
+assert User.migrate_legacy_values() == 2    # stores null and 1 instead
+assert User.query().filter(id=joe.id).values_list("finish_time", "sex") == [(None, True)]
+
+# ==============================================
+
+if asyncio is not None:   # python 3, nanorm sets asyncio to None on python 2
+    # in a coroutine: await User.aget(name="Joe"), await ob.asave(), async for ob in User.query()
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    jack = loop.run_until_complete(User(name="Jack", age=3).asave())       # writes run one by one in a writer thread
+    assert loop.run_until_complete(User.aget(id=jack.id)).name == "Jack"  # reads run in async_workers threads
+    assert loop.run_until_complete(User.query().filter(age=3).acount()) == 1
+    loop.run_until_complete(User.query().filter(age=3).adelete())
+    loop.close()
+    shutdown_async_executor()
+
+# ==============================================
+
+class Event(Model):
+    db_name = "nanorm_events.db"    # the table lives in its own database, None for the current one
+    user = ForeignKey(User)
+    kind = CharField()
+
+Event.query().delete()
+with atomic(db_name=Event.db_name):     # transactions are per database
+    Event(user=joe, kind="login").save()
+
+if sys.version_info >= (3, 4):     # uri names of sqlite need python 3.4+
+    NANO_SETTINGS["read_replicas"] = {"nanorm_events.db": ["file:nanorm_events.db?mode=ro"]}   # reads use read-only connections
+
+event = Event.query().select_related("user").first()    # the user table is read through attach
+assert event.user.name == "Joe"
+assert Event.query().using("nanorm_events.db").count() == 1    # or pick the database yourself
+
+NANO_SETTINGS["read_replicas"] = {}
+
+# ==============================================
+
+add_sql_hook(sql_stats)                         # count the statements per shape
+slow_log = add_sql_hook(SlowQueryLog(0.5))      # log the statements taking 0.5 seconds or more
+
+with NPlusOneDetector(threshold=3) as detector:
+    areas = [user.area for user in User.query()]        # one query per user to load its area
+assert detector.found
+
+with NPlusOneDetector(threshold=3) as detector:
+    areas = [user.area for user in User.query().select_related("area")]
+assert not detector.found
+
+stats = get_sql_stats()                         # {shape: {"calls", "errors", "rows", "seconds", "max_seconds", "lock_wait_seconds"}}
+assert any(shape.startswith("select") for shape in stats)
+
+remove_sql_hook(slow_log)
+remove_sql_hook(sql_stats)
+
+# ==============================================
+
+page = User.query().order("age")[1:3]      # limit 2 offset 1, no sql until it is used
+assert [user.name for user in page] == ["Sandy", "Motive"]
+assert User.query().order("age")[0].name == "Tom"
+
+names = []
+cursor = None
+while True:
+    users, cursor = User.query().order("-age").paginate_after(cursor, page_size=3)   # keyset pagination, an opaque cursor
+    names += [user.name for user in users]
+    if cursor is None:
+        break
+assert names == ["Joe", "Motive", "Sandy", "Tom"]
+
+n = Area.query().count()
+Area.query().order("-id")[:2].delete()     # a slice deletes or updates only its rows
+assert Area.query().count() == n - 2
+
+# ==============================================
+
+users = User.query().filter(name__startswith="T", age__lt=10, area__isnull=True).all()   # lookups of several fields at once
+assert [user.name for user in users] == ["Tom"]
+assert User.query().filter(area__in=[mainland, taiwan], leader__isnull=False).count() == 1
 
+found = User.in_bulk([joe.id, 999])            # id -> object, one `in` query per max_variables ids
+assert list(found) == [joe.id]
 
 # ==============================================
 